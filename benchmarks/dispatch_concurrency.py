@@ -0,0 +1,171 @@
+"""Check that concurrent orders never book the same driver twice.
+
+Posts all orders to ``main.handle_order`` at once against a fake bot, then
+has every offered driver accept at once. A fraction of ``record_offer``
+calls fail on purpose so the cleanup of half-dispatched orders runs too.
+Checks, and exits non-zero if any fails:
+- no driver has an offer for two open orders, and every reserved driver
+  belongs to an open order's current round,
+- every open order has its offer timeout running,
+- no driver is assigned two orders and no order two drivers,
+- no order is left pending in the database.
+
+    python benchmarks/dispatch_concurrency.py [--orders 50] [--drivers 60] [--broadcast 1] [--fail-rate 0.1]
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GROUP_ID = -1000000000001
+
+
+class FakeBot:
+    """Answers the calls the order handlers make after a short random delay"""
+
+    def __init__(self):
+        self.message_ids = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None, reply_to_message_id=None,
+                           rate_limit_args=None):
+        await asyncio.sleep(random.random() * 0.005)
+        self.message_ids += 1
+        return SimpleNamespace(message_id=self.message_ids)
+
+    async def edit_message_text(self, **kwargs):
+        await asyncio.sleep(random.random() * 0.005)
+
+
+async def answer(*args, **kwargs):
+    pass
+
+
+def check(failures, ok, message):
+    print(f"{'ok' if ok else 'FAIL':<5} {message}")
+    if not ok:
+        failures.append(message)
+
+
+async def run(args):
+    import main
+    from database import Order
+    from sqlalchemy import select
+
+    db = main.db
+    await db.init_db()
+    for telegram_id in range(1, args.drivers + 1):
+        await db.add_driver({
+            'telegram_id': telegram_id,
+            'name': f'Driver {telegram_id}',
+            'car_model': 'Lada Vesta',
+            'car_number': f'A{telegram_id:03d}AA',
+            'status': 'inactive',
+        })
+    await asyncio.gather(*(db.add_to_queue(i) for i in range(1, args.drivers + 1)))
+
+    # Fail some offers after they went out, like a database error would
+    record_offer = db.record_offer
+
+    async def flaky_record_offer(*a, **kw):
+        if random.random() < args.fail_rate:
+            raise RuntimeError('injected failure')
+        return await record_offer(*a, **kw)
+    db.record_offer = flaky_record_offer
+
+    context = SimpleNamespace(bot=FakeBot(), bot_data={}, args=None)
+    chat = SimpleNamespace(id=GROUP_ID)
+    updates = [
+        SimpleNamespace(
+            message=SimpleNamespace(chat=chat, text='нужно такси', message_id=1000 + i, reply_text=answer),
+            effective_user=SimpleNamespace(id=999),
+        )
+        for i in range(args.orders)
+    ]
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(main.handle_order(update, context) for update in updates), return_exceptions=True
+    )
+    elapsed = time.perf_counter() - started
+    failed = sum(isinstance(result, Exception) for result in results)
+    db.record_offer = record_offer
+
+    open_orders = [main.orders.get(order_id) for order_id in list(main.orders._orders)]
+    offered = collections.Counter(d for order in open_orders for d in order.offers)
+    print(f"{args.orders} orders, {args.drivers} drivers, broadcast {args.broadcast}, "
+          f"{failed} failed on purpose, dispatched in {elapsed * 1000:.0f} ms")
+    print(f"{len(open_orders)} orders open with {sum(offered.values())} offers")
+
+    failures = []
+    check(failures, not [d for d, n in offered.items() if n > 1],
+          "no driver has offers for two open orders")
+    claims = {
+        (order_id, d)
+        for dispatcher in main.dispatchers.values()
+        for d, order_id in dispatcher._offers.items()
+    }
+    offers = {(order.id, d) for order in open_orders for d in order.offers}
+    check(failures, claims == offers, "reserved drivers match the open offers, none leaked")
+    check(failures, all(order.id in main.timers for order in open_orders),
+          "every open order's round has its timeout running")
+
+    async def accept(order, driver_id):
+        query = SimpleNamespace(
+            from_user=SimpleNamespace(id=driver_id), answer=answer, edit_message_text=answer,
+            message=SimpleNamespace(chat_id=driver_id, message_id=0),
+        )
+        update = SimpleNamespace(callback_query=query, effective_user=query.from_user)
+        await main.accept_order(update, SimpleNamespace(bot=context.bot, bot_data={}, args=[order.id]))
+
+    await asyncio.gather(*(accept(order, d) for order in open_orders for d in list(order.offers)))
+
+    async with db.read_session() as session:
+        rows = (await session.execute(select(Order))).scalars().all()
+    statuses = collections.Counter(row.status for row in rows)
+    drivers = collections.Counter(row.driver_telegram_id for row in rows if row.status == 'accepted')
+    print('orders by status: ' + ', '.join(f'{status} {n}' for status, n in sorted(statuses.items())))
+    check(failures, not [d for d, n in drivers.items() if n > 1], "no driver assigned two orders")
+    check(failures, statuses['accepted'] == len(open_orders), "every open order assigned exactly once")
+    check(failures, not statuses['pending'], "no order left pending")
+    check(failures, not any(main.dispatchers[zone] for zone in main.dispatchers),
+          "no driver left reserved")
+
+    await main.timers.stop()
+    await db.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=50)
+    parser.add_argument('--drivers', type=int, default=60)
+    parser.add_argument('--broadcast', type=int, default=1, help='BROADCAST_SIZE for the order group')
+    parser.add_argument('--fail-rate', type=float, default=0.1, help='share of offers that fail to be recorded')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', help='where to create the database file (default: a temp dir)')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        # main reads its settings when imported
+        os.environ.update({
+            'TELEGRAM_TOKEN': '123456:CONCURRENCY',
+            'GROUP_ID': str(GROUP_ID),
+            'BROADCAST_SIZE': str(args.broadcast),
+            'OFFER_TIMEOUT': '60',
+            'DATABASE_PATH': os.path.join(tmp, 'taxi_bot.db'),
+        })
+        failures = asyncio.run(run(args))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
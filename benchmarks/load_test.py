@@ -0,0 +1,538 @@
+"""End-to-end load test of the bot against a local fake Bot API.
+
+Runs the real Application built by ``main.main()`` with its base URL
+pointed at an in-process HTTP server that speaks just enough of the Bot
+API (getMe, getUpdates, setWebhook, sendMessage, editMessageText,
+answerCallbackQuery). Updates reach the bot through getUpdates, or with
+``--webhook`` are POSTed to the bot's webhook server the way Telegram does.
+Simulated drivers register and join the queue, then the group posts
+orders in bursts while drivers accept, decline or let offers expire.
+Reports update throughput and latency, dispatch results and database
+timings. Everything stays on localhost, so it runs offline.
+
+    python benchmarks/load_test.py [--drivers 1000] [--orders 300] [--order-rate 10] [--webhook]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import callbacks
+
+TOKEN = '123456:LOADTEST'
+GROUP_ID = -1000000000001
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'TaxiBot', 'username': 'taxi_load_bot'}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class FakeBotAPI:
+    """The part of the Telegram Bot API the bot uses, served over local HTTP.
+
+    Updates pushed by the simulation are handed out through getUpdates,
+    or POSTed to the webhook once the bot has set one. Every call the bot makes is passed to ``on_call`` so the simulation can
+    react to it like a Telegram client would.
+    """
+
+    def __init__(self, on_call):
+        self.on_call = on_call
+        self.calls = collections.Counter()
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+        self._server = None
+        self._webhook = None  # (host, port, path, secret token)
+        self._connections = []  # idle keep-alive connections to the webhook
+        self._deliveries = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        for _, writer in self._connections:
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    def push_update(self, update):
+        self._update_id += 1
+        update['update_id'] = self._update_id
+        if self._webhook:
+            task = asyncio.get_running_loop().create_task(self._post_update(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self._updates.append(update)
+            self._new_updates.set()
+        return self._update_id
+
+    async def _post_update(self, update):
+        host, port, path, secret = self._webhook
+        body = json.dumps(update).encode()
+        if self._connections:
+            reader, writer = self._connections.pop()
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        writer.write(
+            f'POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+            f'X-Telegram-Bot-Api-Secret-Token: {secret}\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+        status = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        if b' 200 ' not in status:
+            raise RuntimeError(f"Webhook answered {status!r}")
+        self._connections.append((reader, writer))
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method = request_line.split()[1].decode().rsplit('/', 1)[-1]
+                result = await self._dispatch(method, self._parse(headers, body))
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                    + f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse(headers, body):
+        if not body:
+            return {}
+        if headers.get('content-type', '').startswith('application/json'):
+            return json.loads(body)
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            # The bot sends every non-string parameter JSON encoded
+            try:
+                params[key] = json.loads(value) if key != 'text' else value
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def _dispatch(self, method, params):
+        self.calls[method] += 1
+        if method == 'getMe':
+            return dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=True,
+                        supports_inline_queries=False)
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method == 'setWebhook':
+            url = urlparse(params['url'])
+            self._webhook = (url.hostname, url.port, url.path or '/', params.get('secret_token', ''))
+            return True
+        if method == 'deleteWebhook':
+            self._webhook = None
+            return True
+        result = True
+        if method == 'sendMessage':
+            result = message(self.next_message_id(), params['chat_id'], params.get('text', ''),
+                             sender=BOT_USER)
+        elif method == 'editMessageText' and 'chat_id' in params:
+            result = message(params['message_id'], params['chat_id'], params.get('text', ''),
+                             sender=BOT_USER)
+        self.on_call(method, params, result)
+        return result
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(float(params.get('timeout') or 0), 1.0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get('limit') or 100)
+        return self._updates[:limit]
+
+
+def message(message_id, chat_id, text, sender):
+    chat_type = 'private' if chat_id > 0 else 'supergroup'
+    return {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': chat_type, 'title': None if chat_id > 0 else 'Orders'},
+        'from': sender,
+        'text': text,
+    }
+
+
+def user(telegram_id):
+    return {'id': telegram_id, 'is_bot': False, 'first_name': f'Driver {telegram_id}'}
+
+
+class Simulation:
+    """Drivers and the order group, reacting to what the bot sends them"""
+
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeBotAPI(self.on_call)
+        self.loop = asyncio.get_running_loop()
+        self.random = random.Random(args.seed)
+        # One order group per zone, driver d is in zone d % zones
+        self.groups = [GROUP_ID - i for i in range(args.zones)]
+        self.bot = None  # the main module, imported once the environment is set
+        self._callback_id = 0
+        self._waiters = {}  # key -> future resolved by the bot's reply
+        self.latencies = collections.defaultdict(list)  # update kind -> seconds
+        self.lost = collections.Counter()  # update kind -> updates never answered
+        self.menu_message = {}  # driver -> a bot message with their menu
+        self.orders = {}  # group message id -> posted at
+        self.assigned = []  # seconds from order to "Забирает"
+        self.unassigned = 0
+        self.offers = collections.Counter()  # accepted / declined / ignored
+        self.orders_done = asyncio.Event()
+        self.orders_posted = False
+        self._replied = set()  # orders the group got a first reply to
+        self._tasks = set()
+
+    # Updates from users
+
+    def _send_update(self, kind, update, keys):
+        """Push an update and return a future for the first reply matching any key"""
+        future = self.loop.create_future()
+        for key in keys:
+            self._waiters[key] = future
+        started = self.loop.time()
+
+        def done(f):
+            for key in keys:
+                if self._waiters.get(key) is f:
+                    del self._waiters[key]
+            if not f.cancelled():
+                self.latencies[kind].append(self.loop.time() - started)
+        future.add_done_callback(done)
+        self.api.push_update(update)
+        return future
+
+    async def text(self, kind, chat_id, sender_id, text):
+        message_id = self.api.next_message_id()
+        update = {'message': dict(message(message_id, chat_id, text, user(sender_id)))}
+        if text.startswith('/'):
+            command = text.split()[0]
+            update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return await self._wait(kind, self._send_update(kind, update, [('chat', chat_id)]))
+
+    async def press(self, kind, driver, message_id, data):
+        self._callback_id += 1
+        callback_id = str(self._callback_id)
+        update = {'callback_query': {
+            'id': callback_id,
+            'from': user(driver),
+            'chat_instance': str(driver),
+            'data': data,
+            'message': message(message_id, driver, '', BOT_USER),
+        }}
+        keys = [('callback', callback_id), ('chat', driver)]
+        return await self._wait(kind, self._send_update(kind, update, keys))
+
+    async def _wait(self, kind, future):
+        try:
+            return await asyncio.wait_for(future, self.args.reply_timeout)
+        except asyncio.TimeoutError:
+            self.lost[kind] += 1
+            return None
+
+    # Calls from the bot
+
+    def on_call(self, method, params, result):
+        chat_id = params.get('chat_id')
+        if method == 'answerCallbackQuery':
+            self._resolve(('callback', str(params['callback_query_id'])), result)
+            return
+        if chat_id in self.groups:
+            self._group_reply(params)
+            return
+        buttons = self.buttons(params)
+        if method == 'sendMessage' and 'accept_order' in buttons:
+            self._spawn(self.handle_offer(chat_id, result['message_id'], buttons))
+            return
+        if chat_id is not None:
+            self._resolve(('chat', chat_id), result)
+
+    @staticmethod
+    def buttons(params):
+        """{action name: callback data} of the message's inline keyboard"""
+        markup = params.get('reply_markup') or {}
+        found = {}
+        for row in markup.get('inline_keyboard', ()):
+            for button in row:
+                action, _ = callbacks.decode(button['callback_data'])
+                found[action.name] = button['callback_data']
+        return found
+
+    def _resolve(self, key, result):
+        future = self._waiters.get(key)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _group_reply(self, params):
+        order = params.get('reply_to_message_id')
+        posted = self.orders.get(order)
+        if posted is None:
+            return
+        if order not in self._replied:
+            self._replied.add(order)
+            self.latencies['order'].append(self.loop.time() - posted)
+        text = params.get('text', '')
+        if text.startswith('✅ Забирает'):
+            self.assigned.append(self.loop.time() - posted)
+        elif text.startswith('❌'):
+            self.unassigned += 1
+        else:
+            return  # "Поехали" or a timeout notice, the order is still open
+        del self.orders[order]
+        if not self.orders and self.orders_posted:
+            self.orders_done.set()
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # Scenario
+
+    def join_data(self, driver):
+        if self.args.zones == 1:
+            return self.bot.JOIN_QUEUE.data()
+        return self.bot.JOIN_QUEUE.data(f'z{driver % self.args.zones}')
+
+    async def register(self, driver):
+        menu = await self.text('start', driver, driver, '/start')
+        if menu is None:
+            return
+        await self.press('register', driver, menu['message_id'], self.bot.REGISTER.data())
+        await self.text('registration', driver, driver, f'Driver {driver}')
+        await self.text('registration', driver, driver, 'Lada Vesta')
+        done = await self.text('registration', driver, driver, f'A{driver % 1000:03d}AA')
+        if done is None:
+            return
+        self.menu_message[driver] = done['message_id']
+        await self.press('join_queue', driver, done['message_id'], self.join_data(driver))
+
+    async def handle_offer(self, driver, message_id, buttons):
+        roll = self.random.random()
+        await asyncio.sleep(self.random.uniform(*self.args.think_time))
+        if roll < self.args.accept:
+            self.offers['accepted'] += 1
+            reply = await self.press('accept_order', driver, message_id, buttons['accept_order'])
+            if isinstance(reply, dict) and reply['text'].startswith('✅'):
+                # Back in the queue once the ride is over
+                await asyncio.sleep(self.args.ride_time)
+                await self.press('join_queue', driver, self.menu_message[driver], self.join_data(driver))
+        elif roll < self.args.accept + self.args.decline:
+            self.offers['declined'] += 1
+            await self.press('decline_order', driver, message_id, buttons['decline_order'])
+        else:
+            self.offers['ignored'] += 1
+
+    async def post_orders(self):
+        for i in range(self.args.orders):
+            message_id = self.api.next_message_id()
+            self.orders[message_id] = self.loop.time()
+            self.api.push_update({'message': message(
+                message_id, self.groups[i % len(self.groups)], f'Нужно такси на Ленина {i}, 2 человека',
+                user(999999999)
+            )})
+            await asyncio.sleep(1 / self.args.order_rate)
+        self.orders_posted = True
+        if not self.orders:
+            self.orders_done.set()
+
+
+def report_updates(sim, elapsed, kinds):
+    count = sum(len(sim.latencies[k]) for k in kinds)
+    print(f"{'update':<14} {'count':>7} {'lost':>6} {'p50 ms':>9} {'p99 ms':>9}")
+    for kind in kinds:
+        samples = sim.latencies[kind]
+        print(f"{kind:<14} {len(samples):>7} {sim.lost[kind]:>6} "
+              f"{percentile(samples, 50) * 1000:>9.1f} {percentile(samples, 99) * 1000:>9.1f}")
+    print(f"{count / elapsed:.1f} updates/s over {elapsed:.1f} s")
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = collections.Counter()
+
+    def emit(self, record):
+        self.messages[f'{record.levelname} {record.getMessage()[:90]}'] += 1
+
+
+async def run(args, tmp):
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN,
+        'GROUP_ID': str(GROUP_ID),
+        'ADMIN_PASSWORD': 'load-test',
+        'DATABASE_PATH': os.path.join(tmp, 'load.db'),
+        'OFFER_TIMEOUT': str(args.offer_timeout),
+        'BROADCAST_SIZE': str(args.broadcast),
+    })
+    if args.concurrent_updates:
+        os.environ['CONCURRENT_UPDATES'] = str(args.concurrent_updates)
+    if args.zones > 1:
+        os.environ['ZONES'] = ','.join(f'{GROUP_ID - i}:z{i}' for i in range(args.zones))
+    if args.workers:
+        os.environ.update({'WORKERS': str(args.workers),
+                           'COORDINATOR_SOCKET': os.path.join(tmp, 'coordinator.sock')})
+    if not args.telegram_limits:
+        # Measure the bot, not Telegram's flood limits
+        os.environ.update({'SEND_RATE_GLOBAL': '1000000', 'SEND_RATE_PRIVATE': '1000000',
+                           'SEND_RATE_GROUP': '1000000', 'SEND_BURST': '1000000'})
+
+    sim = Simulation(args)
+    os.environ['TELEGRAM_API_URL'] = await sim.api.start()
+    if args.webhook:
+        os.environ.update({
+            'WEBHOOK_URL': f'http://127.0.0.1:{args.webhook_port}/telegram',
+            'WEBHOOK_LISTEN': '127.0.0.1',
+            'WEBHOOK_PORT': str(args.webhook_port),
+        })
+
+    import main as bot
+    import metrics
+    sim.bot = bot
+    errors = ErrorCounter()
+    logging.getLogger().handlers = [errors]
+
+    application = await bot.main()
+    await application.initialize()
+    await application.post_init(application)
+    if args.webhook:
+        webhook = await bot.start_webhook(application)
+    else:
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+    await application.start()
+    if args.workers:
+        # Updates go to a worker only once it has connected
+        while bot.coordinator.connected() < args.workers:
+            await asyncio.sleep(0.1)
+
+    print(f"{args.drivers} drivers, {args.orders} orders at {args.order_rate}/s, "
+          f"accept {args.accept:.0%} decline {args.decline:.0%}, offer timeout {args.offer_timeout}s, "
+          f"broadcast {args.broadcast}, {'webhook' if args.webhook else 'polling'}, "
+          f"{bot.CONCURRENT_UPDATES} concurrent updates, {bot.WORKERS} workers, {len(bot.ZONE_NAMES)} zones")
+    try:
+        print("\nRegistration")
+        started = time.perf_counter()
+        await asyncio.gather(*(sim.register(1000 + i) for i in range(args.drivers)))
+        report_updates(sim, time.perf_counter() - started, ('start', 'register', 'registration', 'join_queue'))
+        print(f"{len(bot.db.queue)} drivers in the queue")
+
+        print("\nOrders")
+        for kind in ('join_queue',):
+            sim.latencies[kind].clear()
+        started = time.perf_counter()
+        await sim.post_orders()
+        try:
+            await asyncio.wait_for(sim.orders_done.wait(), args.drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"{len(sim.orders)} orders still open after {args.drain_timeout}s")
+        elapsed = time.perf_counter() - started
+        report_updates(sim, elapsed, ('order', 'accept_order', 'decline_order', 'join_queue'))
+        print(f"{len(sim.assigned)} assigned, {sim.unassigned} unassigned, "
+              f"{len(sim.assigned) / elapsed * 60:.0f} assigned orders/min")
+        print(f"time to assign p50 {percentile(sim.assigned, 50):.2f} s, p99 {percentile(sim.assigned, 99):.2f} s")
+        print(f"offers: {dict(sim.offers)}")
+
+        print("\nDatabase")
+        print(f"{'method':<20} {'calls':>7} {'p50 ms':>9} {'p99 ms':>9}")
+        for labels in metrics.DB_SECONDS.label_values():
+            print(f"{labels[0]:<20} {metrics.DB_SECONDS.count(*labels):>7} "
+                  f"{metrics.DB_SECONDS.quantile(0.5, *labels) * 1000:>9.2f} "
+                  f"{metrics.DB_SECONDS.quantile(0.99, *labels) * 1000:>9.2f}")
+        locked = sum(n for text, n in errors.messages.items() if 'locked' in text)
+        print(f"'database is locked' errors: {locked}")
+
+        print(f"\nBot API calls: {dict(sim.api.calls)}")
+        if errors.messages:
+            print("Warnings and errors:")
+            for text, n in errors.messages.most_common(10):
+                print(f"{n:>6}  {text}")
+    finally:
+        if args.webhook:
+            await webhook.stop()
+        else:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await bot.db.close()
+        await sim.api.stop()
+        for task in list(sim._tasks):
+            task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--drivers', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=300)
+    parser.add_argument('--order-rate', type=float, default=10, help='orders posted per second')
+    parser.add_argument('--accept', type=float, default=0.6, help='share of offers accepted')
+    parser.add_argument('--decline', type=float, default=0.2, help='share of offers declined, the rest expire')
+    parser.add_argument('--think-time', type=float, nargs=2, default=(0.1, 1.0),
+                        help='seconds a driver takes to answer an offer, min and max')
+    parser.add_argument('--ride-time', type=float, default=5, help='seconds before a driver rejoins the queue')
+    parser.add_argument('--offer-timeout', type=int, default=2)
+    parser.add_argument('--broadcast', type=int, default=1, help='BROADCAST_SIZE for the order group')
+    parser.add_argument('--webhook', action='store_true', help='deliver updates to the webhook instead of polling')
+    parser.add_argument('--webhook-port', type=int, default=18443)
+    parser.add_argument('--concurrent-updates', type=int, help='CONCURRENT_UPDATES for the bot')
+    parser.add_argument('--workers', type=int, default=0, help='WORKERS, worker processes besides the coordinator')
+    parser.add_argument('--zones', type=int, default=1, help='zones, each with its own order group')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="keep the outbound limiter at Telegram's rates")
+    parser.add_argument('--reply-timeout', type=float, default=30, help='seconds before an update counts as lost')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='seconds to wait for open orders to finish')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', help='where to create the database file (default: a temp dir)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        asyncio.run(run(args, tmp))
+
+
+if __name__ == '__main__':
+    main()
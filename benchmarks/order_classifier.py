@@ -0,0 +1,142 @@
+"""Benchmark group-message order detection on a synthetic chat corpus.
+
+Compares the old hot path of handle_order (GROUP_ID parsing, logging the
+message text at INFO, lowercasing and a substring scan per keyword) with
+the chat filter plus the compiled OrderClassifier, then the keyword check
+alone (all chats) for both.
+
+    python benchmarks/order_classifier.py [--messages 200000] [--order-rate 0.03]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier import OrderClassifier
+
+GROUP_ID = '-1001234567890'
+OTHER_CHAT_ID = -1009876543210
+
+WORDS = (
+    'привет всем кто сегодня работает в центре пробка на мосту опять ремонт '
+    'дорога скользкая осторожно гаи стоит у заправки кофе будет через минут '
+    'спасибо ок да нет понял принял еду стою жду пассажира выхожу на линию '
+    'отказ отказался отказываюсь доброе утро вечер ночь смена закончил обед '
+    'бензин подорожал шины зимние летние вокзал аэропорт торговый центр '
+    'больница рынок школа улица проспект переулок дом подъезд этаж'
+).split()
+ORDER_TEMPLATES = (
+    'Нужно такси от {a} до {b}',
+    'заказ: {a} -> {b}, 2 пассажира',
+    'Поездка {a} {b} срочно',
+    'нужно забрать с {a}, едем на {b}',
+    'Такси к {a} через 10 минут',
+)
+
+
+def build_corpus(size, order_rate, seed=1):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        if rng.random() < order_rate:
+            text = rng.choice(ORDER_TEMPLATES).format(a=rng.choice(WORDS), b=rng.choice(WORDS))
+        else:
+            # Chat messages are mostly short with a long tail
+            length = max(1, min(60, int(rng.lognormvariate(2.0, 0.8))))
+            text = ' '.join(rng.choice(WORDS) for _ in range(length))
+            if rng.random() < 0.5:
+                text = text.capitalize()
+        chat_id = int(GROUP_ID) if rng.random() < 0.7 else OTHER_CHAT_ID
+        corpus.append((chat_id, text))
+    return corpus
+
+
+def legacy_path(corpus, logger):
+    """The checks handle_order used to run for every group message"""
+    hits = 0
+    for chat_id, text in corpus:
+        logger.info(f"Received message in chat {chat_id}: {text}")
+        try:
+            group_id = int(GROUP_ID) if GROUP_ID else None
+        except ValueError:
+            continue
+        if not group_id or chat_id != group_id:
+            logger.info(f"Message from wrong chat. Expected {group_id}, got {chat_id}")
+            continue
+        order_keywords = ['заказ', 'поездка', 'нужно', 'такси']
+        message_text = text.lower()
+        if any(keyword in message_text for keyword in order_keywords):
+            hits += 1
+    return hits
+
+
+def compiled_path(corpus, classifier):
+    """Chat filter parsed once at startup, then the compiled classifier"""
+    chat_ids = frozenset([int(GROUP_ID)])
+    is_order = classifier.is_order
+    hits = 0
+    for chat_id, text in corpus:
+        if chat_id in chat_ids and is_order(text):
+            hits += 1
+    return hits
+
+
+def legacy_scan(corpus):
+    """Only the keyword check of the old path"""
+    order_keywords = ['заказ', 'поездка', 'нужно', 'такси']
+    return sum(1 for _, text in corpus if any(k in text.lower() for k in order_keywords))
+
+
+def compiled_scan(corpus, classifier):
+    """Only the classifier"""
+    is_order = classifier.is_order
+    return sum(1 for _, text in corpus if is_order(text))
+
+
+def timed(fn, *args):
+    best = None
+    for _ in range(3):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--order-rate', type=float, default=0.03)
+    args = parser.parse_args()
+
+    # Log records are created as in production, but go nowhere
+    logger = logging.getLogger('bench.handle_order')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    corpus = build_corpus(args.messages, args.order_rate)
+    classifier = OrderClassifier()
+    legacy_hits, legacy_time = timed(legacy_path, corpus, logger)
+    compiled_hits, compiled_time = timed(compiled_path, corpus, classifier)
+    legacy_scan_hits, legacy_scan_time = timed(legacy_scan, corpus)
+    compiled_scan_hits, compiled_scan_time = timed(compiled_scan, corpus, classifier)
+
+    mean_len = sum(len(text) for _, text in corpus) / len(corpus)
+    print(f"{len(corpus)} messages, mean length {mean_len:.0f} chars, {args.order_rate:.0%} orders")
+    print(f"{'path':<16} {'msgs/s':>12} {'us/msg':>8} {'orders':>8}")
+    for name, hits, elapsed in (
+        ('legacy', legacy_hits, legacy_time),
+        ('compiled', compiled_hits, compiled_time),
+        ('legacy scan', legacy_scan_hits, legacy_scan_time),
+        ('compiled scan', compiled_scan_hits, compiled_scan_time),
+    ):
+        print(f"{name:<16} {len(corpus) / elapsed:>12,.0f} {elapsed / len(corpus) * 1e6:>8.2f} {hits:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Compare the legacy SQLite setup with the tuned storage profile.
+
+Registers drivers, then runs concurrent join/leave cycles while a reader
+keeps pulling the full drivers listing the way the admin panel does.
+Reports queue write throughput and latency for each profile.
+
+    python benchmarks/storage_profiles.py [--drivers 300] [--cycles 5] [--workers 8]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select
+
+from database import Database, Driver
+from storage import StorageProfile
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run_profile(name, profile, drivers, cycles, workers, read_interval):
+    db = Database(profile)
+    await db.init_db()
+    for telegram_id in range(1, drivers + 1):
+        await db.add_driver({
+            'telegram_id': telegram_id,
+            'name': f'Driver {telegram_id}',
+            'car_model': 'Lada Vesta',
+            'car_number': f'A{telegram_id:03d}AA',
+            'status': 'inactive',
+        })
+
+    latencies = []
+    reads = 0
+    done = asyncio.Event()
+
+    async def writer(ids):
+        for _ in range(cycles):
+            for telegram_id in ids:
+                started = time.perf_counter()
+                await db.add_to_queue(telegram_id)
+                await db.remove_from_queue(telegram_id)
+                latencies.append(time.perf_counter() - started)
+
+    async def reader():
+        nonlocal reads
+        while not done.is_set():
+            async with db.read_session() as session:
+                result = await session.execute(select(Driver))
+                result.scalars().all()
+            reads += 1
+            await asyncio.sleep(read_interval)
+
+    ids = list(range(1, drivers + 1))
+    chunks = [ids[i::workers] for i in range(workers)]
+    reader_task = asyncio.create_task(reader())
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(chunk) for chunk in chunks))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await reader_task
+    await db.close()
+
+    print(
+        f"{name:<8} {len(latencies) / elapsed:>10.1f} {percentile(latencies, 50) * 1000:>9.2f} "
+        f"{percentile(latencies, 99) * 1000:>9.2f} {statistics.mean(latencies) * 1000:>9.2f} "
+        f"{reads / elapsed:>10.1f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--drivers', type=int, default=300)
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--read-interval', type=float, default=0.05,
+                        help='pause between admin listings, seconds')
+    parser.add_argument('--dir', help='where to create the database files (default: a temp dir)')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print(f"{args.drivers} drivers, {args.cycles} join/leave cycles each, {args.workers} writers")
+    print(f"{'profile':<8} {'cycles/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'mean ms':>9} {'reads/s':>10}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for name, profile in (
+            ('legacy', StorageProfile.legacy(os.path.join(tmp, 'legacy.db'))),
+            ('tuned', StorageProfile(path=os.path.join(tmp, 'tuned.db'))),
+        ):
+            await run_profile(name, profile, args.drivers, args.cycles,
+                              args.workers, args.read_interval)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,312 @@
+"""Callback data of inline buttons and the handler that routes it.
+
+A button's data is the format version, the action's code and its
+arguments, separated by ':', e.g. ``1a:2s`` accepts order 100: numbers are
+written in base 36 to stay well under Telegram's 64 bytes. CallbackRouter
+decodes the data once and finds the action in a dict, so every extra
+action costs nothing on other buttons' updates.
+
+Buttons in messages sent before the versioned format (``accept_order_100``,
+``admin_queue_list:north:>17``) are still understood.
+
+TapCoalescer runs a button a user taps twice in a row only once.
+"""
+import asyncio
+import logging
+import string
+
+from telegram import Update
+from telegram.ext import BaseHandler
+
+from logs import Event
+
+logger = logging.getLogger(__name__)
+
+VERSION = '1'
+SEPARATOR = ':'
+MAX_DATA_BYTES = 64  # Telegram's limit for callback_data
+
+_DIGITS = string.digits + string.ascii_lowercase
+
+_actions = {}  # code -> Action
+_legacy = {}  # unversioned name -> Action
+
+# answerCallbackQuery parameters that are replayed to repeated taps
+ANSWER_FIELDS = ('text', 'show_alert', 'url', 'cache_time')
+
+
+class CallbackDataError(ValueError):
+    """Callback data that can't be built or doesn't decode"""
+
+
+class Int:
+    """An integer, base 36"""
+
+    def encode(self, value):
+        value = int(value)
+        if value < 0:
+            return '-' + self.encode(-value)
+        digits = ''
+        while True:
+            value, digit = divmod(value, 36)
+            digits = _DIGITS[digit] + digits
+            if not value:
+                return digits
+
+    def decode(self, text):
+        return int(text, 36)
+
+    def decode_legacy(self, text):
+        return int(text)
+
+
+class Str:
+    """A short string such as a zone name"""
+
+    def encode(self, value):
+        if not value or SEPARATOR in value:
+            raise CallbackDataError(f"Can't put {value!r} in callback data")
+        return value
+
+    def decode(self, text):
+        if not text:
+            raise ValueError("empty string argument")
+        return text
+
+    decode_legacy = decode
+
+
+_INT = Int()
+
+
+class Cursor:
+    """A keyset page cursor, (after, before) with one of them set"""
+
+    def encode(self, value):
+        after, before = value
+        return '>' + _INT.encode(after) if after is not None else '<' + _INT.encode(before)
+
+    def decode(self, text, parse=_INT.decode):
+        if text[:1] == '>':
+            return parse(text[1:]), None
+        if text[:1] == '<':
+            return None, parse(text[1:])
+        raise ValueError(f"bad cursor {text!r}")
+
+    def decode_legacy(self, text):
+        return self.decode(text, int)
+
+
+class Action:
+    """A button action: a short code and the types of its arguments.
+
+    name is what the action's data looked like before the versioned format.
+    Arguments are optional from the end, missing ones decode as None.
+    """
+
+    __slots__ = ('name', 'code', 'args')
+
+    def __init__(self, name, code, *args):
+        # The same definition again is fine, e.g. main.py imported as a module too
+        if getattr(_actions.get(code), 'name', name) != name or getattr(_legacy.get(name), 'code', code) != code:
+            raise ValueError(f"Callback action {name} ({code}) clashes with another action")
+        self.name = name
+        self.code = code
+        self.args = args
+        _actions[code] = self
+        _legacy[name] = self
+
+    def __repr__(self):
+        return f'Action({self.name!r}, {self.code!r})'
+
+    def data(self, *values):
+        """Callback data for a button, values as in args with trailing Nones left out"""
+        if len(values) > len(self.args):
+            raise CallbackDataError(f"{self.name} takes at most {len(self.args)} arguments")
+        while values and values[-1] is None:
+            values = values[:-1]
+        data = SEPARATOR.join([VERSION + self.code] + [
+            arg.encode(value) for arg, value in zip(self.args, values)
+        ])
+        if len(data.encode()) > MAX_DATA_BYTES:
+            raise CallbackDataError(f"Callback data of {self.name} is over {MAX_DATA_BYTES} bytes: {data}")
+        return data
+
+
+def decode(data):
+    """(Action, args) for callback data, args padded with None; raises CallbackDataError"""
+    try:
+        if data[:1] == VERSION:
+            code, *texts = data[1:].split(SEPARATOR)
+            action = _actions.get(code)
+            legacy = False
+        else:
+            name, *texts = data.split(SEPARATOR)
+            action = _legacy.get(name)
+            if action is None:
+                # accept_order_<id>
+                name, _, order_id = name.rpartition('_')
+                action, texts = _legacy.get(name), [order_id] + texts
+            legacy = True
+        if action is None or len(texts) > len(action.args):
+            raise CallbackDataError(f"Unknown callback data {data!r}")
+        args = [
+            arg.decode_legacy(text) if legacy else arg.decode(text)
+            for arg, text in zip(action.args, texts)
+        ]
+    except CallbackDataError:
+        raise
+    except (ValueError, TypeError) as e:
+        raise CallbackDataError(f"Bad callback data {data!r}: {e}") from None
+    args.extend([None] * (len(action.args) - len(args)))
+    return action, args
+
+
+def describe(data):
+    """Readable form of callback data, e.g. ``accept_order:100``"""
+    try:
+        action, args = decode(data)
+    except CallbackDataError:
+        return data
+    return SEPARATOR.join([action.name] + [str(arg) for arg in args if arg is not None])
+
+
+class _Tap:
+    __slots__ = ('data', 'done', 'finished', 'ok', 'answer')
+
+    def __init__(self, data):
+        self.data = data
+        self.done = asyncio.Event()
+        self.finished = None  # event loop time
+        self.ok = False
+        self.answer = None  # answerCallbackQuery parameters, if the handler answered
+
+
+class _TapQuery:
+    """A tap's callback query that remembers how the handler answered it.
+
+    Telegram objects are frozen, so the handler gets this stand-in; every
+    other attribute is the query's own.
+    """
+
+    __slots__ = ('_query', '_tap')
+
+    def __init__(self, query, tap):
+        self._query = query
+        self._tap = tap
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    async def answer(self, text=None, show_alert=None, url=None, cache_time=None, **kwargs):
+        values = (text, show_alert, url, cache_time)
+        self._tap.answer = {key: value for key, value in zip(ANSWER_FIELDS, values) if value is not None}
+        return await self._query.answer(text, show_alert, url, cache_time, **kwargs)
+
+
+class _TapUpdate:
+    """The update of a tap, with a _TapQuery for its callback query"""
+
+    __slots__ = ('_update', 'callback_query')
+
+    def __init__(self, update, query):
+        self._update = update
+        self.callback_query = query
+
+    def __getattr__(self, name):
+        return getattr(self._update, name)
+
+
+class TapCoalescer:
+    """Handles a user's repeated taps of the same button once.
+
+    Only the user's last tap is remembered. A tap with the same data that
+    comes while it is still being handled waits for it, one that comes
+    within window seconds after it finished is answered straight away: both
+    get the answer the first tap got, the handler does not run again. Any
+    other tap of the user's, or a first tap that raised, starts over.
+    counter counts the repeats by action name.
+    """
+
+    def __init__(self, counter, window=2.0):
+        self.counter = counter
+        self.window = window
+        self._taps = {}  # user id -> _Tap, least recently tapped first
+
+    def __len__(self):
+        return len(self._taps)
+
+    async def run(self, action, callback, update, context):
+        query = update.callback_query
+        user_id = query.from_user.id
+        loop = asyncio.get_running_loop()
+        tap = self._taps.get(user_id)
+        if tap is not None and tap.data == query.data:
+            if tap.finished is None:
+                await tap.done.wait()
+            if tap.ok and loop.time() - tap.finished <= self.window:
+                self.counter.inc(action.name)
+                logger.debug(Event('tap_repeated', user=user_id, action=action.name))
+                await query.answer(**(tap.answer or {}))
+                return None
+
+        # Re-inserted so the dict stays in the order of the users' last taps
+        self._taps.pop(user_id, None)
+        tap = self._taps[user_id] = _Tap(query.data)
+        self._expire(loop.time())
+        try:
+            result = await callback(_TapUpdate(update, _TapQuery(query, tap)), context)
+            tap.ok = True
+            return result
+        finally:
+            tap.finished = loop.time()
+            tap.done.set()
+            if not tap.ok and self._taps.get(user_id) is tap:
+                del self._taps[user_id]
+
+    def _expire(self, now):
+        while self._taps:
+            user_id, tap = next(iter(self._taps.items()))
+            if tap.finished is None or now - tap.finished <= self.window:
+                break
+            del self._taps[user_id]
+
+
+class CallbackRouter(BaseHandler):
+    """Handles the callback queries of a set of actions, {Action: callback}.
+
+    The callback gets the decoded arguments as context.args. Data that
+    doesn't decode, or belongs to an action of another router, is left for
+    the next handler. With taps, a TapCoalescer, repeated taps are handled
+    once.
+    """
+
+    def __init__(self, callbacks, taps=None, block=True):
+        # There is no single callback, handle_update picks the action's
+        super().__init__(None, block=block)
+        self.callbacks = {action.code: callback for action, callback in callbacks.items()}
+        self.taps = taps
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        data = update.callback_query.data
+        if not data:
+            return None
+        try:
+            action, args = decode(data)
+        except CallbackDataError as e:
+            logger.debug("Ignoring callback: %s", e)
+            return None
+        callback = self.callbacks.get(action.code)
+        return (action, callback, args) if callback is not None else None
+
+    def collect_additional_context(self, context, update, application, check_result):
+        context.args = check_result[2]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        action, callback, _ = check_result
+        if self.taps is None:
+            return await callback(update, context)
+        return await self.taps.run(action, callback, update, context)
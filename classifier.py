@@ -0,0 +1,61 @@
+import os
+import re
+import logging
+
+from telegram.ext import filters
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ORDER_KEYWORDS = ('заказ', 'поездка', 'нужно', 'такси')
+
+
+class OrderClassifier:
+    """Decides whether a group message is a taxi order.
+
+    All keywords are compiled into one case-insensitive alternation, so a
+    message is scanned once no matter how many keywords there are. A keyword
+    matches at the start of a word and covers its endings ("заказ" matches
+    "заказать" but not "отказ"). A message that also matches one of the
+    negative patterns is not an order.
+    """
+
+    def __init__(self, keywords=DEFAULT_ORDER_KEYWORDS, negative_patterns=()):
+        keywords = sorted({k.strip().lower() for k in keywords if k.strip()}, key=len, reverse=True)
+        if not keywords:
+            raise ValueError("At least one order keyword is required")
+        self.keywords = keywords
+        self.negative_patterns = [p for p in negative_patterns if p.strip()]
+        self._keywords = re.compile(
+            r'(?<!\w)(?:' + '|'.join(map(re.escape, keywords)) + ')',
+            re.IGNORECASE
+        )
+        self._negative = re.compile(
+            '|'.join(f'(?:{p})' for p in self.negative_patterns),
+            re.IGNORECASE
+        ) if self.negative_patterns else None
+
+    @classmethod
+    def from_env(cls):
+        """ORDER_KEYWORDS is comma separated, ORDER_NEGATIVE_PATTERNS are regexes separated by ';'"""
+        keywords = os.getenv('ORDER_KEYWORDS')
+        negative = os.getenv('ORDER_NEGATIVE_PATTERNS', '')
+        return cls(
+            keywords.split(',') if keywords else DEFAULT_ORDER_KEYWORDS,
+            negative.split(';')
+        )
+
+    def is_order(self, text):
+        if not text or not self._keywords.search(text):
+            return False
+        return self._negative is None or not self._negative.search(text)
+
+
+class OrderMessageFilter(filters.MessageFilter):
+    """PTB filter passing only messages the classifier takes for orders"""
+
+    def __init__(self, classifier):
+        super().__init__(name='OrderMessageFilter')
+        self.classifier = classifier
+
+    def filter(self, message):
+        return self.classifier.is_order(message.text)
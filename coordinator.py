@@ -0,0 +1,316 @@
+"""Multi-process deployment: one coordinator process and N worker processes.
+
+The coordinator is the only process that takes updates from Telegram and
+the only one that changes the queue or an order, so queue order, offers,
+timeouts and the first-accept-wins race stay exactly as in a single
+process. Every other update is handed to a worker over a Unix socket.
+Workers keep a read-only copy of the queue for menus, profiles and
+listings, and ask the coordinator to make the few queue changes their
+handlers need, such as deleting a queued driver.
+"""
+import os
+import json
+import time
+import asyncio
+import itertools
+import logging
+import multiprocessing
+
+import logs
+from tracing import record
+
+logger = logging.getLogger(__name__)
+
+
+def worker_for(update, count):
+    """Index of the worker that handles an update.
+
+    A user always lands on the same worker, which keeps their user_data
+    (e.g. the registration steps) in one process.
+    """
+    sender = update.effective_user or update.effective_chat
+    return sender.id % count if sender else 0
+
+
+def _encode(message):
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+
+class _WorkerConnection:
+    __slots__ = ('writer', 'pending')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = {}  # sequence number -> future resolved when the worker is done
+
+
+class Coordinator:
+    """Unix socket server the worker processes connect to.
+
+    Each queue change is written to every worker as soon as it happens, on
+    the same connection as the updates, so by the time a worker handles an
+    update it has applied every queue change made before it. ``forward``
+    returns once the worker has handled the update; the coordinator holds
+    the user's update lock until then, so a user's updates stay in order
+    across processes.
+
+    calls maps names to coroutine functions the workers may run here with
+    ``WorkerClient.call``. A call's result is written after the queue
+    changes it made.
+    """
+
+    def __init__(self, queue, path, calls=None):
+        self.queue = queue
+        self.path = path
+        self.calls = calls or {}
+        self._running = set()  # calls from workers in progress
+        self._workers = {}  # worker index -> _WorkerConnection
+        self._counter = itertools.count()
+        self._server = None
+        self._log_levels = {}  # changed at runtime, also sent to workers that connect later
+        queue.subscribe(self._queue_changed)
+
+    def connected(self):
+        return len(self._workers)
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over from a previous run
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+        logger.info("Coordinator listening on %s", self.path)
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for connection in list(self._workers.values()):
+            connection.writer.close()
+        await self._server.wait_closed()
+        self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def forward(self, update, index):
+        """Have worker index handle update.
+
+        Returns False if the worker is not connected or went away before it
+        was done, the caller then handles the update itself.
+        """
+        connection = self._workers.get(index)
+        if connection is None:
+            return False
+        number = next(self._counter)
+        done = asyncio.get_running_loop().create_future()
+        connection.pending[number] = done
+        started = time.perf_counter()
+        connection.writer.write(_encode({'t': 'update', 'n': number, 'update': update.to_dict()}))
+        try:
+            await connection.writer.drain()
+            await done
+        except ConnectionError:
+            logger.error("Worker %s went away while handling update %s", index, update.update_id)
+            return False
+        finally:
+            record('worker', f'worker {index}', started, time.perf_counter() - started)
+        return True
+
+    def set_log_levels(self, levels):
+        """Apply {logger name: level name} in every worker"""
+        self._log_levels.update(levels)
+        message = _encode({'t': 'log_levels', 'levels': levels})
+        for connection in self._workers.values():
+            connection.writer.write(message)
+
+    def _queue_changed(self, zone, event, *args):
+        if event == 'load':
+            for connection in self._workers.values():
+                self._send_snapshot(connection)
+            return
+        message = _encode({'t': 'queue', 'z': zone, 'e': event, 'a': args})
+        for connection in self._workers.values():
+            connection.writer.write(message)
+
+    def _send_snapshot(self, connection):
+        connection.writer.write(_encode({'t': 'queue', 'e': 'load', 'a': [self.queue.rows()]}))
+
+    async def _serve(self, reader, writer):
+        index = connection = None
+        try:
+            hello = json.loads(await reader.readline())
+            index = hello['worker']
+            previous = self._workers.get(index)
+            if previous is not None:
+                previous.writer.close()
+            connection = self._workers[index] = _WorkerConnection(writer)
+            # No await between registering and the snapshot, so no change is missed
+            self._send_snapshot(connection)
+            if self._log_levels:
+                connection.writer.write(_encode({'t': 'log_levels', 'levels': self._log_levels}))
+            logger.info("Worker %s connected (pid %s)", index, hello.get('pid'))
+
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message['t'] == 'done':
+                    done = connection.pending.pop(message['n'], None)
+                    if done is not None and not done.done():
+                        done.set_result(None)
+                elif message['t'] == 'call':
+                    task = asyncio.get_running_loop().create_task(self._call(connection, message))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error("Error in connection to worker %s: %s", index, e)
+        finally:
+            if connection is not None:
+                if self._workers.get(index) is connection:
+                    del self._workers[index]
+                for done in connection.pending.values():
+                    if not done.done():
+                        done.set_exception(ConnectionError(f"Worker {index} disconnected"))
+                logger.warning("Worker %s disconnected", index)
+            writer.close()
+
+    async def _call(self, connection, message):
+        """Run a worker's call and write back its result or error"""
+        reply = {'t': 'result', 'n': message['n']}
+        try:
+            reply['r'] = await self.calls[message['f']](*message['a'])
+        except Exception as e:
+            logger.error("Error in call %s from a worker: %s", message['f'], e)
+            reply['e'] = str(e)
+        if not connection.writer.is_closing():
+            connection.writer.write(_encode(reply))
+
+
+class WorkerClient:
+    """A worker's connection to the coordinator.
+
+    Applies queue changes to the local copy of the zone queues in the order
+    they arrive and runs ``await handle_update(data)`` for every update handed
+    over, several at a time.
+    """
+
+    def __init__(self, queue, path, index):
+        self.queue = queue
+        self.path = path
+        self.index = index
+        self._handling = set()
+        self._writer = None
+        self._counter = itertools.count()
+        self._calls = {}  # sequence number -> future of a call to the coordinator
+
+    async def call(self, name, *args):
+        """Run the coordinator's call name with args there, returns its result.
+
+        Raises ConnectionError without a connection, RuntimeError if the call
+        failed in the coordinator.
+        """
+        if self._writer is None or self._writer.is_closing():
+            raise ConnectionError("Not connected to the coordinator")
+        number = next(self._counter)
+        result = self._calls[number] = asyncio.get_running_loop().create_future()
+        self._writer.write(_encode({'t': 'call', 'n': number, 'f': name, 'a': list(args)}))
+        return await result
+
+    async def run(self, handle_update):
+        """Serve the coordinator until it closes the connection"""
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        writer.write(_encode({'t': 'hello', 'worker': self.index, 'pid': os.getpid()}))
+        self._writer = writer
+        logger.info("Worker %s connected to the coordinator", self.index)
+        loop = asyncio.get_running_loop()
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message['t'] == 'queue':
+                    self._apply(message.get('z'), message['e'], message['a'])
+                elif message['t'] == 'log_levels':
+                    logs.set_levels(message['levels'])
+                elif message['t'] == 'update':
+                    task = loop.create_task(self._handle(handle_update, message, writer))
+                    self._handling.add(task)
+                    task.add_done_callback(self._handling.discard)
+                elif message['t'] == 'result':
+                    self._resolve(message)
+        finally:
+            self._writer = None
+            for result in self._calls.values():
+                if not result.done():
+                    result.set_exception(ConnectionError("Coordinator went away"))
+            self._calls.clear()
+            if self._handling:
+                await asyncio.gather(*self._handling, return_exceptions=True)
+            writer.close()
+
+    def _resolve(self, message):
+        result = self._calls.pop(message['n'], None)
+        if result is None or result.done():
+            return
+        if 'e' in message:
+            result.set_exception(RuntimeError(message['e']))
+        else:
+            result.set_result(message.get('r'))
+
+    def _apply(self, zone, event, args):
+        if event == 'load':
+            self.queue.load(args[0])  # snapshot of every zone
+        elif event == 'append':
+            self.queue.zone(zone).append(*args)
+        elif event == 'remove':
+            self.queue.zone(zone).remove(*args)
+        elif event == 'clear':
+            self.queue.zone(zone).clear()
+
+    async def _handle(self, handle_update, message, writer):
+        try:
+            await handle_update(message['update'])
+        except Exception as e:
+            logger.error("Error handling update in worker %s: %s", self.index, e)
+        finally:
+            if not writer.is_closing():
+                writer.write(_encode({'t': 'done', 'n': message['n']}))
+
+
+class WorkerPool:
+    """Starts the worker processes and restarts any that die"""
+
+    def __init__(self, count, target):
+        self.count = count
+        self.target = target  # module level function taking the worker index
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        self._task = None
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    def _spawn(self, index):
+        process = self._context.Process(target=self.target, args=(index,), name=f'taxi-bot-worker-{index}')
+        process.start()
+        self._processes[index] = process
+        logger.info("Started worker %s (pid %s)", index, process.pid)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(5)
+            for index, process in list(self._processes.items()):
+                if not process.is_alive():
+                    logger.error("Worker %s exited with code %s, restarting it", index, process.exitcode)
+                    self._spawn(index)
+
+    async def stop(self, timeout=10):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes.values():
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.kill()
+        self._processes.clear()
@@ -1,51 +1,254 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, update as sqlalchemy_update
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, LargeBinary, ForeignKey, Index, UniqueConstraint, delete, insert, func, tuple_, update as sqlalchemy_update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.future import select
 from datetime import datetime
+from collections import namedtuple
+from contextlib import asynccontextmanager
+import functools
 import logging
 import asyncio
 
+from queue_engine import DEFAULT_ZONE, ZoneQueues
+from migrations import migrate
+from storage import StorageProfile
+from metrics import REGISTRY, timed_query
+from logs import Event
+
 logger = logging.getLogger(__name__)
 
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'taxi_bot_queue_wait_seconds', 'How long drivers stayed in the queue',
+    buckets=(60, 300, 600, 1800, 3600, 7200, 14400, 28800)
+)
+
 Base = declarative_base()
 
+# queue_zone of units of work that change every zone at once
+ALL_ZONES = '*'
+
+class DriverState(namedtuple('DriverState', ['driver', 'in_queue', 'position', 'zone'])):
+    """Everything the menus need to know about a driver"""
+    __slots__ = ()
+
+    @property
+    def is_registered(self):
+        return self.driver is not None
+
+# One page of a keyset-paginated listing
+Page = namedtuple('Page', ['items', 'has_prev', 'has_next'])
+
+def reports_errors(default):
+    """Make a Database method log an error and return default when it fails.
+
+    Only in a unit of work of its own: given the caller's ``session`` it
+    raises, so the whole unit of work rolls back and its owner decides.
+    """
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, session=None, **kwargs):
+            if session is not None:
+                return await func(self, *args, session=session, **kwargs)
+            try:
+                return await func(self, *args, **kwargs)
+            except Exception as e:
+                logger.error("Error in %s%r: %s", name, args, e)
+                return default
+        return wrapper
+    return decorator
+
 class Driver(Base):
     __tablename__ = 'drivers'
     
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True)
-    name = Column(String)
-    car_model = Column(String)
-    car_number = Column(String)
-    status = Column(String)  # 'active', 'inactive', 'busy'
-    registration_date = Column(DateTime, default=datetime.utcnow)
+    telegram_id = Column(Integer, unique=True, nullable=False)
+    name = Column(String, nullable=False)
+    car_model = Column(String, nullable=False)
+    car_number = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='inactive', index=True)  # 'active', 'inactive', 'busy'
+    registration_date = Column(DateTime, nullable=False, default=datetime.utcnow)
 
 class Queue(Base):
     __tablename__ = 'queue'
     
     id = Column(Integer, primary_key=True)
-    driver_id = Column(Integer, ForeignKey('drivers.id'))
-    position = Column(Integer)
-    join_time = Column(DateTime, default=datetime.utcnow)
+    driver_id = Column(Integer, ForeignKey('drivers.id'), nullable=False, unique=True)
+    zone = Column(String, nullable=False, default=DEFAULT_ZONE)
+    position = Column(Integer, nullable=False)  # ordering key within the zone, increases monotonically; rank comes from QueueEngine
+    join_time = Column(DateTime, nullable=False, default=datetime.utcnow)
     
     driver = relationship("Driver")
 
+    __table_args__ = (Index('ix_queue_zone_position', 'zone', 'position', unique=True),)
+
+# Order lifecycle: pending -> offered -> accepted / expired / unassigned.
+# An order goes back to pending whenever its current offer is declined or times out.
+OPEN_ORDER_STATUSES = ('pending', 'offered')
+
+class Order(Base):
+    __tablename__ = 'orders'
+    # One order per group message, a redelivered update must not post it twice
+    __table_args__ = (UniqueConstraint('chat_id', 'message_id'),)
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    message_id = Column(Integer, nullable=False)  # the order message in the group
+    text = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending')
+    driver_telegram_id = Column(Integer)  # driver who accepted the order
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class OrderOffer(Base):
+    __tablename__ = 'order_offers'
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False, index=True)
+    driver_telegram_id = Column(Integer, nullable=False)
+    message_id = Column(Integer)  # the offer message in the driver's chat
+    status = Column(String, nullable=False, default='offered')  # 'offered', 'accepted', 'declined', 'expired'
+    offered_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    deadline = Column(DateTime, nullable=False)
+
+class PersistedData(Base):
+    """One key of a user's, chat's or the bot's data, see persistence.py"""
+    __tablename__ = 'persistence_data'
+
+    kind = Column(String, primary_key=True)  # 'user', 'chat' or 'bot'
+    owner = Column(Integer, primary_key=True)  # user or chat id, 0 for bot data
+    key = Column(LargeBinary, primary_key=True)  # pickled key
+    value = Column(LargeBinary, nullable=False)  # pickled value
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
 class Database:
-    def __init__(self):
-        self.engine = create_async_engine('sqlite+aiosqlite:///taxi_bot.db', echo=True)
+    def __init__(self, profile=None):
+        self.profile = profile or StorageProfile.from_env()
+        self.engine = create_async_engine(self.profile.url(), **self.profile.engine_options())
+        self.profile.attach(self.engine)
         self.async_session = sessionmaker(
             self.engine, class_=AsyncSession, expire_on_commit=False
         )
 
+        # Separate read-only pool for heavy listings so they never hold up queue writes
+        if self.profile.read_pool_size:
+            self.read_engine = create_async_engine(
+                self.profile.url(read_only=True), **self.profile.engine_options(read_only=True)
+            )
+            self.profile.attach(self.read_engine, read_only=True)
+        else:
+            self.read_engine = self.engine
+        self.read_session = sessionmaker(
+            self.read_engine, class_=AsyncSession, expire_on_commit=False
+        )
+        self.queue = ZoneQueues()
+        self._queue_locks = {}  # zone -> lock held by the unit of work changing it
+        # Worker processes only keep a copy of the queue, the coordinator changes it
+        self.owns_queue = True
+        logger.info("Using %s", self.profile)
+
+    @asynccontextmanager
+    async def transaction(self, session=None, queue_zone=None):
+        """Unit of work: one session, one transaction, one connection.
+
+        Every Database method takes an optional ``session``; passing the one
+        yielded here makes it part of the same transaction, which commits
+        when the block exits and rolls back if it raises. When ``session``
+        is given the caller already owns a unit of work and it is reused.
+
+        Units of work that change a zone's queue pass its name as
+        ``queue_zone`` (ALL_ZONES for every zone); they run one at a time per
+        zone from the membership check to the commit, so two joins can never
+        race each other, while different zones never wait for each other.
+        Only the process that owns the queue may open one.
+
+        Methods marked with ``reports_errors`` raise when given a session, so
+        the whole unit of work rolls back and its owner decides.
+        """
+        if queue_zone is not None and not self.owns_queue:
+            raise RuntimeError("Queue changes are made by the coordinator process")
+        if session is not None:
+            held = session.info.get('queue_zone')
+            if queue_zone is not None and held not in (queue_zone, ALL_ZONES):
+                raise RuntimeError(f"Changes to zone {queue_zone} need a transaction opened with queue_zone={queue_zone!r}")
+            yield session
+            return
+        acquired = []
+        try:
+            for lock in self._zone_locks(queue_zone):
+                await lock.acquire()
+                acquired.append(lock)
+            async with self.async_session() as session:
+                session.info['queue_zone'] = queue_zone
+                async with session.begin():
+                    yield session
+                for callback in session.info.pop('after_commit', []):
+                    callback()
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    @asynccontextmanager
+    async def _reading(self, session=None):
+        """Session for a read: the caller's unit of work if given, else one from the read pool"""
+        if session is not None:
+            yield session
+            return
+        async with self.read_session() as session:
+            yield session
+
+    def _zone_locks(self, queue_zone):
+        """Locks to hold for queue_zone, always taken in the same order"""
+        if queue_zone is None:
+            return []
+        zones = set(self.queue.zones()) | set(self._queue_locks) if queue_zone == ALL_ZONES else {queue_zone}
+        return [self._queue_locks.setdefault(zone, asyncio.Lock()) for zone in sorted(zones)]
+
+    @staticmethod
+    def _after_commit(session, callback):
+        """Run callback once the unit of work owning session commits"""
+        session.info.setdefault('after_commit', []).append(callback)
+
+    async def close(self):
+        await self.engine.dispose()
+        if self.read_engine is not self.engine:
+            await self.read_engine.dispose()
+
     async def init_db(self):
-        async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+        await migrate(self.engine)
+        await self.load_queue()
 
-    async def add_driver(self, driver_data):
-        async with self.async_session() as session:
-            try:
+    @timed_query
+    async def load_queue(self, session=None):
+        """Load the in-memory queue from the queue table"""
+        async with self.transaction(session) as session:
+            result = await session.execute(
+                select(Queue.zone, Driver.telegram_id, Queue.position)
+                .join(Queue, Queue.driver_id == Driver.id)
+                .order_by(Queue.zone, Queue.position)
+            )
+            self.queue.load(result.all())
+
+            # Keep driver statuses in line with queue membership
+            await session.execute(
+                sqlalchemy_update(Driver)
+                .where(Driver.telegram_id.in_(list(self.queue)), Driver.status != 'active')
+                .values(status='active')
+            )
+            await session.execute(
+                sqlalchemy_update(Driver)
+                .where(Driver.telegram_id.not_in(list(self.queue)), Driver.status == 'active')
+                .values(status='inactive')
+            )
+        logger.info("Queue loaded: %s drivers in %s zones", len(self.queue), len(self.queue.zones()))
+
+    @timed_query
+    async def add_driver(self, driver_data, session=None):
+        try:
+            async with self.transaction(session) as session:
                 driver = Driver(
                     telegram_id=driver_data['telegram_id'],
                     name=driver_data['name'],
@@ -54,171 +257,447 @@ class Database:
                     status=driver_data['status']
                 )
                 session.add(driver)
-                await session.commit()
-                logger.info(f"Driver added: {driver_data['telegram_id']}")
-            except Exception as e:
-                logger.error(f"Error adding driver: {e}")
-                await session.rollback()
-                raise
+            logger.info(Event('driver_added', driver=driver_data['telegram_id']))
+        except Exception as e:
+            logger.error("Error adding driver: %s", e)
+            raise
 
-    async def get_driver(self, telegram_id):
-        async with self.async_session() as session:
-            try:
-                result = await session.execute(
-                    select(Driver).where(Driver.telegram_id == telegram_id)
-                )
-                return result.scalar_one_or_none()
-            except Exception as e:
-                logger.error(f"Error getting driver: {e}")
-                return None
+    @timed_query
+    @reports_errors(None)
+    async def get_driver(self, telegram_id, session=None):
+        async with self._reading(session) as session:
+            result = await session.execute(
+                select(Driver).where(Driver.telegram_id == telegram_id)
+            )
+            return result.scalar_one_or_none()
 
-    async def is_driver_registered(self, telegram_id):
-        try:
-            driver = await self.get_driver(telegram_id)
-            return driver is not None
-        except Exception as e:
-            logger.error(f"Error checking driver registration: {e}")
-            return False
+    @timed_query
+    @reports_errors(DriverState(None, False, None, None))
+    async def get_driver_state(self, telegram_id, session=None):
+        """Driver, queue membership, zone and rank in it in a single query"""
+        async with self._reading(session) as session:
+            result = await session.execute(
+                select(Driver, Queue.zone, Queue.position)
+                .outerjoin(Queue, Queue.driver_id == Driver.id)
+                .where(Driver.telegram_id == telegram_id)
+            )
+            row = result.first()
+        if row is None:
+            return DriverState(None, False, None, None)
+        in_queue = row.position is not None
+        position = self.queue.rank(telegram_id) if in_queue else None
+        return DriverState(row.Driver, in_queue, position, row.zone)
 
-    async def add_to_queue(self, telegram_id):
-        async with self.async_session() as session:
-            try:
-                # Get driver
-                driver = await self.get_driver(telegram_id)
-                if not driver:
-                    logger.error(f"Driver not found: {telegram_id}")
-                    return False
+    async def _keyset_page(self, query, key, after, before, limit):
+        """Run query for the page after or before a key value.
 
-                # Check if already in queue
-                result = await session.execute(
-                    select(Queue).where(Queue.driver_id == driver.id)
-                )
-                if result.scalar_one_or_none():
-                    logger.warning(f"Driver already in queue: {telegram_id}")
-                    return False
+        Only limit + 1 rows are read whatever the table size, the extra row
+        tells whether there is another page in that direction.
+        """
+        if before is not None:
+            query = query.where(key < before).order_by(key.desc())
+        else:
+            if after is not None:
+                query = query.where(key > after)
+            query = query.order_by(key)
+        async with self.read_session() as session:
+            result = await session.execute(query.limit(limit + 1))
+            rows = result.all()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+            return Page(rows, more, True)
+        return Page(rows, after is not None, more)
 
-                # Get last position in queue
-                result = await session.execute(
-                    select(Queue).order_by(Queue.position.desc())
-                )
-                last_queue = result.scalar_one_or_none()
-                new_position = 1 if not last_queue else last_queue.position + 1
+    @timed_query
+    async def get_drivers_page(self, after_id=None, before_id=None, limit=10):
+        """Drivers ordered by id, one page at a time"""
+        page = await self._keyset_page(select(Driver), Driver.id, after_id, before_id, limit)
+        return page._replace(items=[row.Driver for row in page.items])
 
-                # Add to queue
-                queue_entry = Queue(driver_id=driver.id, position=new_position)
-                session.add(queue_entry)
-                
-                # Update driver status
-                driver.status = 'active'
-                
-                await session.commit()
-                logger.info(f"Driver added to queue: {telegram_id}, position: {new_position}")
-                return True
-            except Exception as e:
-                logger.error(f"Error adding to queue: {e}")
-                await session.rollback()
+    @timed_query
+    async def get_queue_page(self, zone, after_position=None, before_position=None, limit=10):
+        """A zone's queue entries joined with their drivers in queue order, one page at a time.
+
+        Items are (rank, position, join_time, driver) tuples.
+        """
+        page = await self._keyset_page(
+            select(Queue.position, Queue.join_time, Driver)
+            .join(Driver, Queue.driver_id == Driver.id)
+            .where(Queue.zone == zone),
+            Queue.position, after_position, before_position, limit
+        )
+        if not page.items:
+            return page
+        first_rank = self.queue.zone(zone).rank(page.items[0].Driver.telegram_id) or 1
+        return page._replace(items=[
+            (first_rank + i, row.position, row.join_time, row.Driver)
+            for i, row in enumerate(page.items)
+        ])
+
+    @timed_query
+    @reports_errors(False)
+    async def is_driver_registered(self, telegram_id, session=None):
+        driver = await self.get_driver(telegram_id, session=session)
+        return driver is not None
+
+    @timed_query
+    @reports_errors(False)
+    async def set_driver_status(self, telegram_id, status, session=None):
+        async with self.transaction(session) as session:
+            result = await session.execute(
+                sqlalchemy_update(Driver)
+                .where(Driver.telegram_id == telegram_id)
+                .values(status=status)
+            )
+            return result.rowcount > 0
+
+    @timed_query
+    @reports_errors(False)
+    async def add_to_queue(self, telegram_id, zone=DEFAULT_ZONE, session=None):
+        async with self.transaction(session, queue_zone=zone) as session:
+            # Get driver
+            driver = await self.get_driver(telegram_id, session=session)
+            if not driver:
+                logger.error(Event('driver_not_found', driver=telegram_id))
                 return False
 
-    async def remove_from_queue(self, telegram_id):
-        async with self.async_session() as session:
-            try:
-                # Get driver
-                driver = await self.get_driver(telegram_id)
-                if not driver:
-                    logger.error(f"Driver not found: {telegram_id}")
-                    return False
+            # Check if already in the queue of any zone
+            if telegram_id in self.queue:
+                logger.warning(Event('queue_join_rejected', driver=telegram_id, reason='already_queued'))
+                return False
 
-                # Remove from queue
-                result = await session.execute(
-                    select(Queue).where(Queue.driver_id == driver.id)
-                )
-                queue_entry = result.scalar_one_or_none()
+            queue = self.queue.zone(zone)
+            new_position = queue.reserve_position()
+
+            # Add to queue
+            queue_entry = Queue(driver_id=driver.id, zone=zone, position=new_position)
+            session.add(queue_entry)
                 
-                if queue_entry:
-                    await session.delete(queue_entry)
-                    driver.status = 'inactive'
-                    await session.commit()
-                    
-                    # Reorder queue positions
-                    await self.reorder_queue()
-                    logger.info(f"Driver removed from queue: {telegram_id}")
-                    return True
-                logger.warning(f"Driver not in queue: {telegram_id}")
+            # Update driver status
+            driver.status = 'active'
+            self._after_commit(session, lambda: queue.append(telegram_id, new_position))
+        logger.info(Event('queue_joined', driver=telegram_id, zone=zone, position=new_position))
+        return True
+
+    @timed_query
+    @reports_errors(False)
+    async def remove_from_queue(self, telegram_id, session=None):
+        zone = self.queue.zone_of(telegram_id)
+        if zone is None:
+            logger.warning(Event('driver_not_in_queue', driver=telegram_id))
+            return False
+        async with self.transaction(session, queue_zone=zone) as session:
+            if self.queue.zone_of(telegram_id) != zone:
+                logger.warning(Event('driver_not_in_queue', driver=telegram_id, zone=zone, reason='left_meanwhile'))
                 return False
-            except Exception as e:
-                logger.error(f"Error removing from queue: {e}")
-                await session.rollback()
+
+            # Get driver
+            driver = await self.get_driver(telegram_id, session=session)
+            if not driver:
+                logger.error(Event('driver_not_found', driver=telegram_id))
                 return False
 
-    async def is_driver_in_queue(self, telegram_id):
-        async with self.async_session() as session:
-            try:
-                driver = await self.get_driver(telegram_id)
-                if not driver:
-                    return False
-                
-                # Check both queue table and driver status
-                result = await session.execute(
-                    select(Queue).join(Driver).where(Driver.telegram_id == telegram_id)
-                )
-                in_queue = result.scalar_one_or_none() is not None
-                
-                # If statuses don't match, fix it
-                if in_queue != (driver.status == 'active'):
-                    driver.status = 'active' if in_queue else 'inactive'
-                    await session.commit()
-                
-                return in_queue
-            except Exception as e:
-                logger.error(f"Error checking queue status: {e}")
+            # Remove from queue
+            result = await session.execute(
+                select(Queue).where(Queue.driver_id == driver.id)
+            )
+            queue_entry = result.scalar_one_or_none()
+            if not queue_entry:
+                logger.warning(Event('driver_not_in_queue', driver=telegram_id))
                 return False
 
+            await session.delete(queue_entry)
+            driver.status = 'inactive'
+            waited = (datetime.utcnow() - queue_entry.join_time).total_seconds()
+            self._after_commit(session, lambda: self.queue.zone(zone).remove(telegram_id))
+            self._after_commit(session, lambda: QUEUE_WAIT_SECONDS.observe(waited))
+        logger.info(Event('queue_left', driver=telegram_id, zone=zone))
+        return True
+
+    async def is_driver_in_queue(self, telegram_id):
+        return telegram_id in self.queue
+
     async def get_queue_position(self, telegram_id):
-        async with self.async_session() as session:
-            try:
-                driver = await self.get_driver(telegram_id)
-                if not driver:
-                    return None
-                
-                result = await session.execute(
-                    select(Queue).where(Queue.driver_id == driver.id)
-                )
-                queue_entry = result.scalar_one_or_none()
-                return queue_entry.position if queue_entry else None
-            except Exception as e:
-                logger.error(f"Error getting queue position: {e}")
+        return self.queue.rank(telegram_id)
+
+    @timed_query
+    async def get_longest_waits(self):
+        """Seconds the driver who joined first has been waiting, per zone with a non-empty queue"""
+        async with self.read_session() as session:
+            result = await session.execute(
+                select(Queue.zone, func.min(Queue.join_time)).group_by(Queue.zone)
+            )
+            rows = result.all()
+        now = datetime.utcnow()
+        return {zone: (now - joined).total_seconds() for zone, joined in rows}
+
+    async def get_first_in_queue(self, zone=DEFAULT_ZONE, session=None):
+        telegram_id = self.queue.zone(zone).first()
+        if telegram_id is None:
+            return None
+        return await self.get_driver(telegram_id, session=session)
+
+    @timed_query
+    @reports_errors(False)
+    async def move_to_back(self, telegram_id, session=None):
+        """Give a queued driver a new position behind everyone else in their zone"""
+        zone = self.queue.zone_of(telegram_id)
+        if zone is None:
+            return False
+        async with self.transaction(session, queue_zone=zone) as session:
+            if self.queue.zone_of(telegram_id) != zone:
+                return False
+            queue = self.queue.zone(zone)
+            new_position = queue.reserve_position()
+            await session.execute(
+                sqlalchemy_update(Queue)
+                .where(Queue.driver_id == select(Driver.id)
+                       .where(Driver.telegram_id == telegram_id)
+                       .scalar_subquery())
+                .values(position=new_position)
+            )
+
+            def requeue():
+                queue.remove(telegram_id)
+                queue.append(telegram_id, new_position)
+            self._after_commit(session, requeue)
+        logger.info(Event('queue_moved_back', driver=telegram_id, position=new_position))
+        return True
+
+    @timed_query
+    @reports_errors(None)
+    async def assign_order(self, telegram_id, order_id=None, session=None):
+        """Take a driver out of the queue and mark them busy in one transaction.
+
+        With ``order_id`` the order and the driver's offer are marked accepted
+        and offers still out to other drivers are withdrawn in the same
+        transaction. Returns the driver, or None if they are unknown or not
+        in the queue.
+        """
+        zone = self.queue.zone_of(telegram_id)
+        if zone is None:
+            logger.warning(Event('driver_not_in_queue', driver=telegram_id))
+            return None
+        async with self.transaction(session, queue_zone=zone) as session:
+            driver = await self.get_driver(telegram_id, session=session)
+            if not driver:
+                logger.error(Event('driver_not_found', driver=telegram_id))
                 return None
+            if not await self.remove_from_queue(telegram_id, session=session):
+                return None
+            driver.status = 'busy'
+            if order_id is not None:
+                # Nested calls raise on errors, rolling the whole assignment back
+                await self.close_offer(order_id, telegram_id, 'accepted', session=session)
+                await session.execute(
+                    sqlalchemy_update(OrderOffer)
+                    .where(
+                        OrderOffer.order_id == order_id,
+                        OrderOffer.driver_telegram_id != telegram_id,
+                        OrderOffer.status == 'offered'
+                    )
+                    .values(status='withdrawn')
+                )
+                if not await self.set_order_status(
+                    order_id, 'accepted', driver_telegram_id=telegram_id, session=session
+                ):
+                    raise LookupError(f"Order not found: {order_id}")
+        logger.info(Event('order_assigned', order=order_id, driver=telegram_id))
+        return driver
 
-    async def reorder_queue(self):
-        async with self.async_session() as session:
-            try:
-                result = await session.execute(
-                    select(Queue).order_by(Queue.join_time)
+    @timed_query
+    async def create_order(self, chat_id, message_id, text, session=None):
+        """Record a new order, returns its id or None if the message was recorded already"""
+        async with self.transaction(session) as session:
+            result = await session.execute(
+                sqlite_insert(Order)
+                .values(chat_id=chat_id, message_id=message_id, text=text, status='pending')
+                .on_conflict_do_nothing(index_elements=['chat_id', 'message_id'])
+                .returning(Order.id)
+            )
+            order_id = result.scalar_one_or_none()
+        if order_id is None:
+            logger.info(Event('order_duplicate', chat=chat_id, message=message_id))
+            return None
+        logger.debug(Event('order_stored', order=order_id, chat=chat_id, message=message_id))
+        return order_id
+
+    @timed_query
+    @reports_errors(False)
+    async def set_order_status(self, order_id, status, driver_telegram_id=None, session=None):
+        """Returns False if the order is unknown"""
+        values = {'status': status, 'updated_at': datetime.utcnow()}
+        if driver_telegram_id is not None:
+            values['driver_telegram_id'] = driver_telegram_id
+        async with self.transaction(session) as session:
+            result = await session.execute(
+                sqlalchemy_update(Order).where(Order.id == order_id).values(**values)
+            )
+            return result.rowcount > 0
+
+    @timed_query
+    async def expire_orders(self, order_ids, session=None):
+        """Close orders that were left open for too long"""
+        if not order_ids:
+            return
+        async with self.transaction(session) as session:
+            await session.execute(
+                sqlalchemy_update(OrderOffer)
+                .where(OrderOffer.order_id.in_(order_ids), OrderOffer.status == 'offered')
+                .values(status='expired')
+            )
+            await session.execute(
+                sqlalchemy_update(Order)
+                .where(Order.id.in_(order_ids))
+                .values(status='expired', updated_at=datetime.utcnow())
+            )
+        logger.info(Event('orders_expired', count=len(order_ids)))
+
+    @timed_query
+    @reports_errors(False)
+    async def record_offer(self, order_id, driver_telegram_id, message_id, deadline, session=None):
+        """Append an offer for an order and mark the order offered if it is still open"""
+        async with self.transaction(session) as session:
+            await session.execute(
+                insert(OrderOffer).values(
+                    order_id=order_id,
+                    driver_telegram_id=driver_telegram_id,
+                    message_id=message_id,
+                    deadline=deadline,
+                    status='offered'
                 )
-                queue_entries = result.scalars().all()
-                
-                for i, entry in enumerate(queue_entries, 1):
-                    entry.position = i
-                
-                await session.commit()
-                logger.info("Queue reordered successfully")
-            except Exception as e:
-                logger.error(f"Error reordering queue: {e}")
-                await session.rollback()
+            )
+            # Another driver of the same broadcast may have accepted meanwhile
+            await session.execute(
+                sqlalchemy_update(Order)
+                .where(Order.id == order_id, Order.status.in_(OPEN_ORDER_STATUSES))
+                .values(status='offered', updated_at=datetime.utcnow())
+            )
+        return True
 
-    async def get_first_in_queue(self):
-        async with self.async_session() as session:
-            try:
-                result = await session.execute(
-                    select(Queue).order_by(Queue.position).limit(1)
+    @timed_query
+    @reports_errors(False)
+    async def close_offer(self, order_id, driver_telegram_id, status, session=None):
+        """Finish a driver's live offer with status ('accepted', 'declined', 'expired').
+
+        Once a declined or expired offer was the last one out, the order is
+        back to pending.
+        """
+        async with self.transaction(session) as session:
+            await session.execute(
+                sqlalchemy_update(OrderOffer)
+                .where(
+                    OrderOffer.order_id == order_id,
+                    OrderOffer.driver_telegram_id == driver_telegram_id,
+                    OrderOffer.status == 'offered'
                 )
-                queue_entry = result.scalar_one_or_none()
-                if queue_entry:
-                    driver_result = await session.execute(
-                        select(Driver).where(Driver.id == queue_entry.driver_id)
+                .values(status=status)
+            )
+            if status != 'accepted':
+                live_offers = select(OrderOffer.id).where(
+                    OrderOffer.order_id == order_id, OrderOffer.status == 'offered'
+                )
+                await session.execute(
+                    sqlalchemy_update(Order)
+                    .where(Order.id == order_id, Order.status == 'offered', ~live_offers.exists())
+                    .values(status='pending', updated_at=datetime.utcnow())
+                )
+        return True
+
+    @timed_query
+    async def get_open_orders(self, session=None):
+        """Open orders with all their offers so far, oldest first.
+
+        Returns a list of (order, [offer, ...]) pairs from a single query.
+        """
+        async with self._reading(session) as session:
+            result = await session.execute(
+                select(Order, OrderOffer)
+                .outerjoin(OrderOffer, OrderOffer.order_id == Order.id)
+                .where(Order.status.in_(OPEN_ORDER_STATUSES))
+                .order_by(Order.id, OrderOffer.id)
+            )
+            orders = {}
+            for order, offer in result.all():
+                offers = orders.setdefault(order.id, (order, []))[1]
+                if offer is not None:
+                    offers.append(offer)
+        return list(orders.values())
+
+    @timed_query
+    async def delete_driver(self, telegram_id, session=None):
+        """Remove a driver and their queue entry, returns False if not found.
+
+        Raises on errors, so they are not taken for a missing driver. Only
+        the process that owns the queue can delete a queued driver.
+        """
+        try:
+            async with self.transaction(session, queue_zone=self.queue.zone_of(telegram_id)) as session:
+                driver = await self.get_driver(telegram_id, session=session)
+                if not driver:
+                    return False
+                if telegram_id in self.queue:
+                    await self.remove_from_queue(telegram_id, session=session)
+                await session.delete(driver)
+            logger.info(Event('driver_deleted', driver=telegram_id))
+            return True
+        except Exception as e:
+            logger.error("Error deleting driver: %s", e)
+            raise
+
+    @timed_query
+    @reports_errors(False)
+    async def reset_queue(self, session=None):
+        """Empty the queues of all zones"""
+        async with self.transaction(session, queue_zone=ALL_ZONES) as session:
+            await session.execute(delete(Queue))
+            await session.execute(
+                sqlalchemy_update(Driver).values(status='inactive')
+            )
+            self._after_commit(session, self.queue.clear)
+        logger.info("Queue reset")
+        return True
+
+    @timed_query
+    async def get_persisted_data(self, kind, owner, session=None):
+        """Pickled (key, value) pairs stored for one owner"""
+        async with self._reading(session) as session:
+            result = await session.execute(
+                select(PersistedData.key, PersistedData.value)
+                .where(PersistedData.kind == kind, PersistedData.owner == owner)
+            )
+            return result.all()
+
+    @timed_query
+    async def write_persisted_data(self, drops, deletes, upserts, session=None):
+        """Apply a batch of persistence changes in one transaction.
+
+        drops are (kind, owner) pairs losing all their keys, deletes are
+        (kind, owner, key) and upserts (kind, owner, key, value), applied in
+        that order. Raises on failure so the caller can keep the batch.
+        """
+        async with self.transaction(session) as session:
+            for kind, owner in drops:
+                await session.execute(
+                    delete(PersistedData).where(PersistedData.kind == kind, PersistedData.owner == owner)
+                )
+            if deletes:
+                await session.execute(
+                    delete(PersistedData).where(
+                        tuple_(PersistedData.kind, PersistedData.owner, PersistedData.key).in_(list(deletes))
                     )
-                    return driver_result.scalar_one_or_none()
-                return None
-            except Exception as e:
-                logger.error(f"Error getting first in queue: {e}")
-                return None 
\ No newline at end of file
+                )
+            if upserts:
+                statement = sqlite_insert(PersistedData)
+                await session.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=['kind', 'owner', 'key'],
+                        set_={'value': statement.excluded.value, 'updated_at': statement.excluded.updated_at},
+                    ),
+                    [
+                        {'kind': kind, 'owner': owner, 'key': key, 'value': value, 'updated_at': datetime.utcnow()}
+                        for kind, owner, key, value in upserts
+                    ],
+                )
@@ -0,0 +1,65 @@
+import logging
+
+from logs import Event
+
+logger = logging.getLogger(__name__)
+
+
+class OrderDispatcher:
+    """Hands queued drivers out to orders, one open offer per driver.
+
+    ``claim_top`` walks the in-memory queue from the head and marks the
+    first drivers without an open offer as offered, all without awaiting,
+    so concurrent orders on the event loop always get distinct drivers.
+    An offer stays claimed until it is released on accept, decline or
+    timeout.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._offers = {}  # telegram_id -> order_id offered to them
+        self._misses = {}  # telegram_id -> offers missed in a row
+
+    def __len__(self):
+        return len(self._offers)
+
+    def claim_top(self, order_id, count, exclude=()):
+        """Reserve up to count free drivers from the head of the queue at once.
+
+        Returns their telegram ids in queue order, an empty list if nobody is
+        free.
+        """
+        claimed = []
+        for telegram_id in self.queue:
+            if len(claimed) == count:
+                break
+            if telegram_id in self._offers or telegram_id in exclude:
+                continue
+            self._offers[telegram_id] = order_id
+            claimed.append(telegram_id)
+        if claimed:
+            logger.debug(Event('drivers_claimed', order=order_id, drivers=tuple(claimed)))
+        return claimed
+
+    def claim(self, order_id, telegram_id):
+        """Reserve a specific driver, e.g. when restoring offers after a restart"""
+        if telegram_id not in self.queue or telegram_id in self._offers:
+            return False
+        self._offers[telegram_id] = order_id
+        return True
+
+    def release(self, order_id, telegram_id):
+        """Free a driver's offer for order_id, returns False if it was not theirs"""
+        if self._offers.get(telegram_id) != order_id:
+            return False
+        del self._offers[telegram_id]
+        logger.debug(Event('driver_released', order=order_id, driver=telegram_id))
+        return True
+
+    def record_miss(self, telegram_id):
+        """Count an offer the driver let expire, returns the running total"""
+        self._misses[telegram_id] = self._misses.get(telegram_id, 0) + 1
+        return self._misses[telegram_id]
+
+    def reset_misses(self, telegram_id):
+        self._misses.pop(telegram_id, None)
@@ -0,0 +1,161 @@
+"""Logging setup: records are written by a background thread.
+
+The event loop only creates a record and puts it on a queue; formatting and
+stream I/O happen in a QueueListener thread. Per-update messages are Event
+objects, rendered as ``name key=value ...`` (or JSON with LOG_FORMAT=json)
+only when they are written. Records below WARNING are rate limited per call
+site, so a burst of group messages can't flood the log.
+"""
+import os
+import json
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def _quote(value):
+    text = str(value)
+    if text and not any(c in text for c in ' ="'):
+        return text
+    return json.dumps(text, ensure_ascii=False)
+
+
+class Event:
+    """Log message made of an event name and fields, rendered only when written.
+
+    Field values are read in the logging thread, pass values that are not
+    changed afterwards (ids, counts, copies).
+    """
+
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, /, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return self.name + ''.join(f' {key}={_quote(value)}' for key, value in self.fields.items())
+
+
+class TextFormatter(logging.Formatter):
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f'{text} suppressed={suppressed}' if suppressed else text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, Event fields as top-level keys"""
+
+    def format(self, record):
+        entry = {}
+        if isinstance(record.msg, Event):
+            entry.update(record.msg.fields)
+            entry['event'] = record.msg.name
+        else:
+            entry['message'] = record.getMessage()
+        entry.update(time=self.formatTime(record), level=record.levelname, logger=record.name)
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through at most rate records per second per call site below WARNING.
+
+    Each call site (file and line) has a token bucket of burst records. The
+    number of records dropped is added to the next one let through as
+    ``suppressed``. Warnings and errors always pass.
+    """
+
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._sites = {}  # (pathname, lineno) -> [tokens, updated, suppressed]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        site = self._sites.get(key)
+        if site is None:
+            site = self._sites[key] = [self.burst, record.created, 0]
+        site[0] = min(self.burst, site[0] + (record.created - site[1]) * self.rate)
+        site[1] = record.created
+        if site[0] < 1:
+            site[2] += 1
+            return False
+        site[0] -= 1
+        if site[2]:
+            record.suppressed = site[2]
+            site[2] = 0
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The stock prepare formats the message here, on the event loop. The
+        # record never leaves the process, so hand it over as it is.
+        return record
+
+
+def parse_levels(text):
+    """``name=LEVEL,...`` as a dict, ``root`` names the root logger"""
+    levels = {}
+    for item in text.replace(',', ' ').split():
+        name, _, level = item.partition('=')
+        level = level.upper()
+        if not name or not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Bad log level setting: {item}")
+        levels[name] = level
+    return levels
+
+
+def set_levels(levels):
+    """Apply {logger name: level name}, takes effect straight away"""
+    for name, level in levels.items():
+        logging.getLogger(None if name == 'root' else name).setLevel(level)
+
+
+def current_levels():
+    """Loggers with a level of their own, {name: level name}"""
+    levels = {'root': logging.getLevelName(logging.getLogger().level)}
+    for name, logger in sorted(logging.Logger.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
+
+
+def setup_from_env():
+    """Route all logging through a background thread, configured by LOG_* variables"""
+    formatter = JsonFormatter() if os.getenv('LOG_FORMAT', 'text') == 'json' else TextFormatter(TEXT_FORMAT)
+    stream = logging.StreamHandler()
+    stream.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(SamplingFilter(
+        rate=float(os.getenv('LOG_SAMPLE_RATE', '10')),
+        burst=float(os.getenv('LOG_SAMPLE_BURST', '50')),
+    ))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    listener = QueueListener(records, stream, respect_handler_level=True)
+    listener.start()
+    # Write out what is still queued when the process exits
+    atexit.register(listener.stop)
+
+    # httpx logs every Bot API request at INFO
+    try:
+        set_levels(parse_levels(os.getenv('LOG_LEVELS', 'httpx=WARNING')))
+    except ValueError as e:
+        logging.getLogger(__name__).error("Ignoring LOG_LEVELS: %s", e)
+    return listener
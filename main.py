@@ -2,58 +2,227 @@ import os
 import logging
 import asyncio
 import re
-from datetime import datetime
+import time
+import secrets
+import signal
+import socket
+from urllib.parse import urlparse
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
-    CallbackQueryHandler,
+    CallbackContext,
     MessageHandler,
+    PersistenceInput,
+    TypeHandler,
     ContextTypes,
     filters,
 )
-from database import Database, Driver, Queue
-from sqlalchemy import select, delete, update
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+from database import Database
+from queue_engine import DEFAULT_ZONE
+from dispatch import OrderDispatcher
+from orders import OrderRecord, OrderRegistry
+from timers import TimerService
+from classifier import OrderClassifier, OrderMessageFilter
+from outbox import OutboundLimiter, URGENT
+from callbacks import Action, CallbackRouter, Cursor, Int, Str, TapCoalescer
+import metrics
+from metrics import REGISTRY, timed_handler
+from updates import PerUserUpdateProcessor, TracingApplication, WebhookServer, allowed_updates_for
+from coordinator import Coordinator, WorkerClient, WorkerPool, worker_for
+from persistence import SQLitePersistence
+import logs
+from logs import Event
 
 # Load environment variables
 load_dotenv()
+
+# Configure logging, records are written by a background thread
+logs.setup_from_env()
+logger = logging.getLogger(__name__)
 TOKEN = os.getenv('TELEGRAM_TOKEN')
+# Bot API server, e.g. a local one or the load test's fake; defaults to api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
 GROUP_ID = os.getenv('GROUP_ID')  # ID группы, где будут публиковаться заказы
+try:
+    ORDER_CHAT_IDS = [int(GROUP_ID)] if GROUP_ID else []
+except ValueError:
+    logger.error("Invalid GROUP_ID format: %s", GROUP_ID)
+    ORDER_CHAT_IDS = []
+OFFER_TIMEOUT = int(os.getenv('OFFER_TIMEOUT', '30'))  # секунд на принятие заказа
+
+def parse_chat_overrides(value: str, cast=int):
+    """Per-group settings like "-100123:45,-100456:20" as {chat_id: value}"""
+    return {
+        int(chat_id): cast(setting.strip())
+        for chat_id, setting in (item.split(':', 1) for item in value.split(',') if item.strip())
+    }
+
+OFFER_TIMEOUTS = parse_chat_overrides(os.getenv('OFFER_TIMEOUTS', ''))
+# How many drivers from the head of the queue get an order at once, first to accept wins
+BROADCAST_SIZE = int(os.getenv('BROADCAST_SIZE', '1'))
+BROADCAST_SIZES = parse_chat_overrides(os.getenv('BROADCAST_SIZES', ''))
+
+# Order groups and the zone whose queue serves each, like "-100123:moscow,-100456:spb".
+# GROUP_ID is in the default zone unless listed here.
+CHAT_ZONES = parse_chat_overrides(os.getenv('ZONES', ''), cast=str)
+for chat_id, zone in list(CHAT_ZONES.items()):
+    # Zone names go into callback data, which is limited to 64 bytes
+    if not re.fullmatch(r'[\w-]{1,16}', zone):
+        logger.error("Invalid zone name for chat %s: %r", chat_id, zone)
+        del CHAT_ZONES[chat_id]
+for chat_id in ORDER_CHAT_IDS:
+    CHAT_ZONES.setdefault(chat_id, DEFAULT_ZONE)
+ORDER_CHAT_IDS = list(CHAT_ZONES)
+ZONE_NAMES = sorted(set(CHAT_ZONES.values())) or [DEFAULT_ZONE]
+
+# Drivers who miss this many offers in a row go to the back of the queue, 0 turns it off
+MISSED_OFFERS_LIMIT = int(os.getenv('MISSED_OFFERS_LIMIT', '0'))
+ORDER_MAX_AGE = int(os.getenv('ORDER_MAX_AGE', '600'))  # open orders older than this are closed, also after a restart
+# Open orders kept in memory at most, the oldest are closed beyond that
+MAX_OPEN_ORDERS = int(os.getenv('MAX_OPEN_ORDERS', '10000'))
+# Webhook mode when WEBHOOK_URL is set (the public https URL Telegram posts to), polling otherwise
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Updates processed at the same time, updates of one user always run one after another
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+# Worker processes for updates that don't change the queue or an order, 0 runs everything in one process
+WORKERS = int(os.getenv('WORKERS', '0'))
+COORDINATOR_SOCKET = os.getenv('COORDINATOR_SOCKET', 'taxi_bot.sock')
+if WORKERS and not hasattr(socket, 'AF_UNIX'):
+    logger.error("WORKERS needs Unix sockets, running in a single process")
+    WORKERS = 0
+# Seconds between saves of user_data (registration progress) to the database, 0 keeps it in memory only
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '10'))
+# Updates slower than this many milliseconds are logged with where their time went, 0 turns tracing off
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '0'))
+# A button tapped again within this many seconds gets the first tap's answer without running again, 0 = off
+CALLBACK_DEBOUNCE = float(os.getenv('CALLBACK_DEBOUNCE', '2'))
+# Prometheus endpoint, off unless a port is set
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+def offer_timeout(chat_id: int):
+    """Seconds a driver has to accept an order from chat_id"""
+    return OFFER_TIMEOUTS.get(chat_id, OFFER_TIMEOUT)
+
+def broadcast_size(chat_id: int):
+    """Drivers an order from chat_id is offered to at the same time"""
+    return max(1, BROADCAST_SIZES.get(chat_id, BROADCAST_SIZE))
+
+def zone_for_chat(chat_id: int):
+    """Zone whose queue takes the orders from chat_id"""
+    return CHAT_ZONES.get(chat_id, DEFAULT_ZONE)
+
+def zone_label(zone: str):
+    """Zone name to show next to a queue, nothing when there is only one zone"""
+    return f" «{zone}»" if len(ZONE_NAMES) > 1 else ""
 
 # Initialize database
 db = Database()
+dispatchers = {}  # zone -> OrderDispatcher over that zone's queue
+timers = TimerService()
+orders = OrderRegistry(ttl=ORDER_MAX_AGE, max_orders=MAX_OPEN_ORDERS)
+# Timer key of the periodic sweep for orders older than ORDER_MAX_AGE
+ORDER_SWEEP = 'order_sweep'
+ORDER_SWEEP_INTERVAL = min(60, max(1, ORDER_MAX_AGE / 10))
+order_classifier = OrderClassifier.from_env()
+outbound = OutboundLimiter.from_env()
+# Set in main() when the bot runs with worker processes
+coordinator = None
+workers = None
+worker_client = None  # in a worker process, its connection to the coordinator
+
+# Dispatch metrics
+ORDERS_TOTAL = REGISTRY.counter('taxi_bot_orders_total', 'Orders by how they ended', ('outcome',))
+OFFERS_TOTAL = REGISTRY.counter('taxi_bot_offers_total', 'Offers by how they ended', ('result',))
+OFFERS_PER_ORDER = REGISTRY.histogram(
+    'taxi_bot_offers_per_order', 'Offers sent for an order until it was taken or given up',
+    buckets=(1, 2, 3, 5, 8, 13, 21)
+)
+TIME_TO_ACCEPT = REGISTRY.histogram(
+    'taxi_bot_time_to_accept_seconds', 'From the order message to a driver accepting it',
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300)
+)
+QUEUE_LENGTH = REGISTRY.gauge('taxi_bot_queue_length', 'Drivers in the queue', ('zone',))
+QUEUE_LONGEST_WAIT = REGISTRY.gauge(
+    'taxi_bot_queue_longest_wait_seconds', 'How long the first driver has been waiting', ('zone',)
+)
+OPEN_ORDERS = REGISTRY.gauge('taxi_bot_open_orders', 'Orders still looking for a driver')
+OPEN_OFFERS = REGISTRY.gauge('taxi_bot_open_offers', 'Drivers with an offer waiting for an answer')
+OUTBOUND_PENDING = REGISTRY.gauge('taxi_bot_outbound_pending', 'Bot API requests waiting for the rate limiter')
+CALLBACKS_REPEATED = REGISTRY.counter(
+    'taxi_bot_callbacks_repeated_total', 'Repeated button taps answered without running the handler', ('action',)
+)
+MENU_EDITS_SKIPPED = REGISTRY.counter('taxi_bot_menu_edits_skipped_total', 'Menu edits that would not change the menu')
+
+taps = TapCoalescer(CALLBACKS_REPEATED, CALLBACK_DEBOUNCE) if CALLBACK_DEBOUNCE > 0 else None
+# What each menu message was last edited to, (chat id, message id) -> (text, keyboard)
+shown_menus = {}
+MAX_SHOWN_MENUS = 10000
+
+def dispatcher_for(zone: str):
+    """The dispatcher handing out drivers of zone's queue"""
+    dispatcher = dispatchers.get(zone)
+    if dispatcher is None:
+        dispatcher = dispatchers[zone] = OrderDispatcher(db.queue.zone(zone))
+    return dispatcher
+
+# Inline button actions, the handlers get the arguments as context.args
+REGISTER = Action('register', 'r')
+PROFILE = Action('profile', 'p')
+JOIN_QUEUE = Action('join_queue', 'j', Str())  # zone, asked for if missing
+LEAVE_QUEUE = Action('leave_queue', 'l')
+ACCEPT_ORDER = Action('accept_order', 'a', Int())  # order id
+DECLINE_ORDER = Action('decline_order', 'd', Int())  # order id
+ADMIN_DRIVERS_LIST = Action('admin_drivers_list', 'dl', Cursor())
+ADMIN_QUEUE_LIST = Action('admin_queue_list', 'ql', Str(), Cursor())  # zone, cursor
+ADMIN_RESET_QUEUE = Action('admin_reset_queue', 'qr')
+ADMIN_DELETE_DRIVER = Action('admin_delete_driver', 'dd')
+
+# Main menu keyboards, one per driver state
+REGISTER_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Регистрация", callback_data=REGISTER.data())]
+])
+JOIN_QUEUE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👉 Встать в очередь", callback_data=JOIN_QUEUE.data())],
+    [InlineKeyboardButton("👤 Мой профиль", callback_data=PROFILE.data())]
+])
+LEAVE_QUEUE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔁 Отбиться", callback_data=LEAVE_QUEUE.data())],
+    [InlineKeyboardButton("👤 Мой профиль", callback_data=PROFILE.data())]
+])
+# With more than one zone, drivers pick the zone whose queue they join
+ZONE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"📍 {zone}", callback_data=JOIN_QUEUE.data(zone))] for zone in ZONE_NAMES
+])
+ADMIN_ZONE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"📍 {zone}", callback_data=ADMIN_QUEUE_LIST.data(zone))] for zone in ZONE_NAMES
+])
+
+def menu_for_state(state):
+    """Pick the main menu keyboard for a driver state"""
+    if not state.is_registered:
+        return REGISTER_MENU
+    return LEAVE_QUEUE_MENU if state.in_queue else JOIN_QUEUE_MENU
 
 # Command handlers
 async def get_main_menu(user_id: int):
     """Get main menu keyboard based on user state"""
-    is_registered = await db.is_driver_registered(user_id)
-    is_in_queue = await db.is_driver_in_queue(user_id)
-    
-    keyboard = []
-    
-    if not is_registered:
-        keyboard.append([InlineKeyboardButton("📝 Регистрация", callback_data="register")])
-    else:
-        if not is_in_queue:
-            keyboard.append([InlineKeyboardButton("👉 Встать в очередь", callback_data="join_queue")])
-        else:
-            keyboard.append([InlineKeyboardButton("🔁 Отбиться", callback_data="leave_queue")])
-        keyboard.append([InlineKeyboardButton("👤 Мой профиль", callback_data="profile")])
-    
-    return InlineKeyboardMarkup(keyboard)
+    return menu_for_state(await db.get_driver_state(user_id))
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command handler"""
-    logger.info(f"Start command received from user {update.effective_user.id}")
+    logger.info(Event('command', name='start', user=update.effective_user.id))
     reply_markup = await get_main_menu(update.effective_user.id)
     await update.message.reply_text(
         "Добро пожаловать в систему распределения заказов такси!\n"
@@ -61,9 +230,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Help command handler"""
-    logger.info(f"Help command received from user {update.effective_user.id}")
+    logger.info(Event('command', name='help', user=update.effective_user.id))
     help_text = (
         "📱 Доступные команды:\n\n"
         "/start - Начать работу с ботом\n"
@@ -77,24 +247,31 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(help_text)
 
-async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin command handler"""
-    logger.info(f"Admin command received from user {update.effective_user.id}")
-    
+async def check_admin_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Check the password passed as the first command argument, telling the user if it is wrong"""
     if not context.args:
         await update.message.reply_text("❌ Пожалуйста, укажите пароль администратора")
-        return
+        return False
         
     if context.args[0] != ADMIN_PASSWORD:
-        logger.warning(f"Invalid admin password attempt from user {update.effective_user.id}")
+        logger.warning(Event('admin_password_wrong', user=update.effective_user.id))
         await update.message.reply_text("❌ Неверный пароль администратора")
+        return False
+    return True
+
+@timed_handler
+async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command handler"""
+    logger.info(Event('command', name='admin', user=update.effective_user.id))
+    
+    if not await check_admin_password(update, context):
         return
 
     keyboard = [
-        [InlineKeyboardButton("📋 Список водителей", callback_data="admin_drivers_list")],
-        [InlineKeyboardButton("👥 Текущая очередь", callback_data="admin_queue_list")],
-        [InlineKeyboardButton("🔄 Сбросить очередь", callback_data="admin_reset_queue")],
-        [InlineKeyboardButton("❌ Удалить водителя", callback_data="admin_delete_driver")]
+        [InlineKeyboardButton("📋 Список водителей", callback_data=ADMIN_DRIVERS_LIST.data())],
+        [InlineKeyboardButton("👥 Текущая очередь", callback_data=ADMIN_QUEUE_LIST.data())],
+        [InlineKeyboardButton("🔄 Сбросить очередь", callback_data=ADMIN_RESET_QUEUE.data())],
+        [InlineKeyboardButton("❌ Удалить водителя", callback_data=ADMIN_DELETE_DRIVER.data())]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
@@ -103,15 +280,90 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+def all_zones():
+    """Configured zones and any zone drivers are still queued in"""
+    return sorted(set(ZONE_NAMES) | set(db.queue.zones()))
+
+async def collect_gauges(application: Application):
+    """Refresh the gauges before a scrape or /stats"""
+    waits = await db.get_longest_waits()
+    for zone in all_zones():
+        QUEUE_LENGTH.set(len(db.queue.zone(zone)), zone)
+        QUEUE_LONGEST_WAIT.set(waits.get(zone, 0.0), zone)
+    OPEN_ORDERS.set(len(orders))
+    OPEN_OFFERS.set(sum(len(dispatcher) for dispatcher in dispatchers.values()))
+    OUTBOUND_PENDING.set(outbound.pending())
+
+def format_latencies(histogram, title):
+    """p50/p95 and call count for every label of a latency histogram"""
+    lines = [title]
+    for labels in histogram.label_values():
+        lines.append(
+            f"{labels[0]}: {histogram.quantile(0.5, *labels) * 1000:.0f} / "
+            f"{histogram.quantile(0.95, *labels) * 1000:.0f} мс, {histogram.count(*labels)}"
+        )
+    return "\n".join(lines)
+
+@timed_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin summary of the metrics, /stats <password>"""
+    if not await check_admin_password(update, context):
+        return
+    
+    await REGISTRY.collect()
+    p50, p95 = TIME_TO_ACCEPT.quantile(0.5), TIME_TO_ACCEPT.quantile(0.95)
+    stats_text = (
+        "📊 Статистика\n\n"
+        + "".join(
+            f"В очереди{zone_label(zone)}: {QUEUE_LENGTH.value(zone)}, "
+            f"дольше всех ждёт {QUEUE_LONGEST_WAIT.value(zone) // 60:.0f} мин.\n"
+            for zone in all_zones()
+        )
+        + f"Открытые заказы: {OPEN_ORDERS.value()}, ждут ответа: {OPEN_OFFERS.value()}\n"
+        f"Заказы: принято {ORDERS_TOTAL.value('accepted')}, без водителя {ORDERS_TOTAL.value('unassigned')}\n"
+        f"Предложения: отправлено {OFFERS_TOTAL.value('sent')}, отказов {OFFERS_TOTAL.value('declined')}, "
+        f"истекло {OFFERS_TOTAL.value('expired')}\n"
+        f"Время до принятия: "
+        + (f"{p50:.1f} / {p95:.1f} с (p50 / p95)" if p50 is not None else "нет данных")
+        + f"\nИсходящие в очереди: {OUTBOUND_PENDING.value()}\n\n"
+        + format_latencies(metrics.HANDLER_SECONDS, "Обработчики (p50 / p95, вызовов):")
+        + "\n\n"
+        + format_latencies(metrics.DB_SECONDS, "База данных (p50 / p95, вызовов):")
+    )
+    await update.message.reply_text(stats_text)
+
+@timed_handler
+async def log_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or change log levels at runtime, /loglevel <password> [logger=LEVEL ...]"""
+    if not await check_admin_password(update, context):
+        return
+
+    if len(context.args) > 1:
+        try:
+            levels = logs.parse_levels(' '.join(context.args[1:]))
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        logs.set_levels(levels)
+        if coordinator is not None:
+            coordinator.set_log_levels(levels)
+        logger.warning(Event('log_levels_changed', user=update.effective_user.id, levels=levels))
+    await update.message.reply_text(
+        "📝 Уровни логирования:\n"
+        + "\n".join(f"{name}: {level}" for name, level in logs.current_levels().items())
+    )
+
+@timed_handler
 async def register_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start registration process"""
     query = update.callback_query
     user_id = query.from_user.id
     
     # Check if already registered
-    if await db.is_driver_registered(user_id):
+    state = await db.get_driver_state(user_id)
+    if state.is_registered:
         await query.answer("Вы уже зарегистрированы!")
-        await update_menu_message(query.message, user_id)
+        await update_menu_message(query.message, menu_for_state(state))
         return
     
     context.user_data['registration_step'] = 'name'
@@ -119,6 +371,7 @@ async def register_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Начинаем регистрацию. Пожалуйста, введите ваше имя:"
     )
 
+@timed_handler
 async def handle_registration_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle registration process inputs"""
     if not context.user_data.get('registration_step'):
@@ -152,60 +405,73 @@ async def handle_registration_input(update: Update, context: ContextTypes.DEFAUL
         context.user_data.clear()
         
         # Send success message with updated menu
-        reply_markup = await get_main_menu(update.message.from_user.id)
         await update.message.reply_text(
             "✅ Регистрация успешно завершена!\n"
             "Теперь вы можете встать в очередь на получение заказов.",
-            reply_markup=reply_markup
+            reply_markup=JOIN_QUEUE_MENU
         )
 
+@timed_handler
 async def join_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Add driver to the queue"""
+    """Add driver to the queue of the zone they picked"""
     query = update.callback_query
     driver_id = query.from_user.id
+    zone, = context.args
     
     try:
-        if not await db.is_driver_registered(driver_id):
+        state = await db.get_driver_state(driver_id)
+        if not state.is_registered:
             await query.answer(
                 "❌ Вы не зарегистрированы. Пожалуйста, сначала пройдите регистрацию.",
                 show_alert=True
             )
             return
 
-        if await db.is_driver_in_queue(driver_id):
-            position = await db.get_queue_position(driver_id)
+        if state.in_queue:
             await query.answer(
-                f"❗ Вы уже находитесь в очереди (позиция: {position})",
+                f"❗ Вы уже находитесь в очереди{zone_label(state.zone)} (позиция: {state.position})",
                 show_alert=True
             )
             return
 
-        if await db.add_to_queue(driver_id):
+        if not zone:
+            if len(ZONE_NAMES) > 1:
+                await query.answer()
+                await update_menu_message(query.message, ZONE_MENU, "Выберите зону:")
+                return
+            zone = ZONE_NAMES[0]
+        elif zone not in ZONE_NAMES:
+            await query.answer("❌ Такой зоны больше нет", show_alert=True)
+            return
+
+        if await db.add_to_queue(driver_id, zone):
             position = await db.get_queue_position(driver_id)
             await query.answer(
                 f"✅ Вы добавлены в очередь! Ваша позиция: {position}",
                 show_alert=True
             )
-            await update_menu_message(query.message, driver_id)
+            await update_menu_message(query.message, LEAVE_QUEUE_MENU)
         else:
             await query.answer(
                 "❌ Произошла ошибка при добавлении в очередь",
                 show_alert=True
             )
     except Exception as e:
-        logger.error(f"Error in join_queue: {e}")
+        logger.error("Error in join_queue: %s", e)
         await query.answer(
             "❌ Произошла ошибка. Попробуйте позже",
             show_alert=True
         )
 
+@timed_handler
 async def leave_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Remove driver from the queue"""
     query = update.callback_query
     driver_id = query.from_user.id
     
     try:
-        if not await db.is_driver_in_queue(driver_id):
+        state = await db.get_driver_state(driver_id)
+        if not state.in_queue:
             await query.answer(
                 "❗ Вы не находитесь в очереди",
                 show_alert=True
@@ -217,36 +483,38 @@ async def leave_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "✅ Вы вышли из очереди",
                 show_alert=True
             )
-            await update_menu_message(query.message, driver_id)
+            await update_menu_message(query.message, JOIN_QUEUE_MENU)
         else:
             await query.answer(
                 "❌ Произошла ошибка при выходе из очереди",
                 show_alert=True
             )
     except Exception as e:
-        logger.error(f"Error in leave_queue: {e}")
+        logger.error("Error in leave_queue: %s", e)
         await query.answer(
             "❌ Произошла ошибка. Попробуйте позже",
             show_alert=True
         )
 
+@timed_handler
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show driver's profile"""
     query = update.callback_query
     driver_id = query.from_user.id
     
     try:
-        driver = await db.get_driver(driver_id)
+        state = await db.get_driver_state(driver_id)
+        driver = state.driver
         if not driver:
             await query.message.reply_text(
                 "❌ Профиль не найден. Пожалуйста, пройдите регистрацию."
             )
             return
 
-        is_in_queue = await db.is_driver_in_queue(driver_id)
-        queue_position = await db.get_queue_position(driver_id) if is_in_queue else None
-        
-        status = f"✅ В очереди (позиция: {queue_position})" if is_in_queue else "❌ Не в очереди"
+        status = (
+            f"✅ В очереди{zone_label(state.zone)} (позиция: {state.position})" if state.in_queue
+            else "❌ Не в очереди"
+        )
         profile_text = (
             f"👤 Профиль водителя:\n\n"
             f"Имя: {driver.name}\n"
@@ -256,70 +524,101 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         await query.message.reply_text(profile_text)
     except Exception as e:
-        logger.error(f"Error in show_profile: {e}")
+        logger.error("Error in show_profile: %s", e)
         await query.message.reply_text(
             "❌ Произошла ошибка при получении профиля"
         )
 
 # Admin handlers
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', '10'))
+
+def page_keyboard(action: Action, page, first_key, last_key, *args):
+    """Prev/next buttons carrying the keyset cursor of the neighbouring page after args"""
+    buttons = []
+    if page.has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=action.data(*args, (None, first_key))))
+    if page.has_next:
+        buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=action.data(*args, (last_key, None))))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def show_admin_page(query, context: ContextTypes.DEFAULT_TYPE, text: str, reply_markup):
+    """Send the first page as a new message, edit the message in place for the rest"""
+    if any(arg is not None for arg in context.args):
+        await query.answer()
+        await query.message.edit_text(text, reply_markup=reply_markup)
+    else:
+        await query.message.reply_text(text, reply_markup=reply_markup)
+
+@timed_handler
 async def admin_drivers_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show list of all registered drivers"""
-    async with db.async_session() as session:
-        result = await session.execute(select(Driver))
-        drivers = result.scalars().all()
+    """Show registered drivers, one page at a time"""
+    query = update.callback_query
+    cursor, = context.args
+    after, before = cursor or (None, None)
+    page = await db.get_drivers_page(after, before, limit=ADMIN_PAGE_SIZE)
+    
+    if not page.items:
+        await query.message.reply_text("📋 Список водителей пуст")
+        return
         
-        if not drivers:
-            await update.callback_query.message.reply_text("📋 Список водителей пуст")
-            return
-            
-        drivers_text = "📋 Список зарегистрированных водителей:\n\n"
-        for driver in drivers:
-            status = "✅ В очереди" if driver.status == "active" else "❌ Не в очереди"
-            drivers_text += (
-                f"ID: {driver.telegram_id}\n"
-                f"Имя: {driver.name}\n"
-                f"Авто: {driver.car_model}\n"
-                f"Номер: {driver.car_number}\n"
-                f"Статус: {status}\n"
-                f"Дата регистрации: {driver.registration_date.strftime('%d.%m.%Y %H:%M')}\n"
-                f"{'='*30}\n"
-            )
-        await update.callback_query.message.reply_text(drivers_text)
+    drivers_text = "📋 Список зарегистрированных водителей:\n\n"
+    for driver in page.items:
+        status = "✅ В очереди" if driver.status == "active" else "❌ Не в очереди"
+        drivers_text += (
+            f"ID: {driver.telegram_id}\n"
+            f"Имя: {driver.name}\n"
+            f"Авто: {driver.car_model}\n"
+            f"Номер: {driver.car_number}\n"
+            f"Статус: {status}\n"
+            f"Дата регистрации: {driver.registration_date.strftime('%d.%m.%Y %H:%M')}\n"
+            f"{'='*30}\n"
+        )
+    reply_markup = page_keyboard(
+        ADMIN_DRIVERS_LIST, page, page.items[0].id, page.items[-1].id
+    )
+    await show_admin_page(query, context, drivers_text, reply_markup)
 
+@timed_handler
 async def admin_queue_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show current queue"""
-    async with db.async_session() as session:
-        result = await session.execute(
-            select(Queue).order_by(Queue.position)
-        )
-        queue_entries = result.scalars().all()
-        
-        if not queue_entries:
-            await update.callback_query.message.reply_text("👥 Очередь пуста")
+    """Show a zone's queue, one page at a time"""
+    query = update.callback_query
+    zone, cursor = context.args
+    if zone is None:
+        if len(ZONE_NAMES) > 1:
+            await query.message.reply_text("👥 Выберите зону:", reply_markup=ADMIN_ZONE_MENU)
             return
-            
-        queue_text = "👥 Текущая очередь:\n\n"
-        for entry in queue_entries:
-            driver = await db.get_driver(entry.driver.telegram_id)
-            queue_text += (
-                f"{entry.position}. {driver.name}\n"
-                f"   Авто: {driver.car_model}\n"
-                f"   Номер: {driver.car_number}\n"
-                f"   Время в очереди: {(datetime.utcnow() - entry.join_time).seconds // 60} мин.\n"
-                f"{'='*30}\n"
-            )
-        await update.callback_query.message.reply_text(queue_text)
+        zone = ZONE_NAMES[0]
+    after, before = cursor or (None, None)
+    page = await db.get_queue_page(zone, after, before, limit=ADMIN_PAGE_SIZE)
+    
+    if not page.items:
+        await query.message.reply_text("👥 Очередь пуста")
+        return
+        
+    now = datetime.utcnow()
+    queue_text = f"👥 Текущая очередь{zone_label(zone)} ({len(db.queue.zone(zone))}):\n\n"
+    for rank, position, join_time, driver in page.items:
+        queue_text += (
+            f"{rank}. {driver.name}\n"
+            f"   Авто: {driver.car_model}\n"
+            f"   Номер: {driver.car_number}\n"
+            f"   Время в очереди: {int((now - join_time).total_seconds()) // 60} мин.\n"
+            f"{'='*30}\n"
+        )
+    reply_markup = page_keyboard(
+        ADMIN_QUEUE_LIST, page, page.items[0][1], page.items[-1][1], zone
+    )
+    await show_admin_page(query, context, queue_text, reply_markup)
 
+@timed_handler
 async def admin_reset_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset the queue"""
-    async with db.async_session() as session:
-        await session.execute(delete(Queue))
-        await session.execute(
-            update(Driver).values(status='inactive')
-        )
-        await session.commit()
+    if not await db.reset_queue():
+        await update.callback_query.message.reply_text("❌ Не удалось сбросить очередь")
+        return
     await update.callback_query.message.reply_text("✅ Очередь успешно сброшена")
 
+@timed_handler
 async def admin_delete_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete a driver"""
     context.user_data['admin_action'] = 'delete_driver'
@@ -327,6 +626,12 @@ async def admin_delete_driver(update: Update, context: ContextTypes.DEFAULT_TYPE
         "Введите ID водителя, которого нужно удалить:"
     )
 
+async def delete_driver(telegram_id: int):
+    """Delete a driver in the process that owns the queue, returns False if not found"""
+    if db.owns_queue:
+        return await db.delete_driver(telegram_id)
+    return await worker_client.call('delete_driver', telegram_id)
+
 async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin input for various actions"""
     action = context.user_data.get('admin_action')
@@ -334,285 +639,599 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if action == 'delete_driver':
         try:
             driver_id = int(update.message.text)
-            async with db.async_session() as session:
-                # Remove from queue first
-                await db.remove_from_queue(driver_id)
-                
-                # Delete driver
-                driver = await db.get_driver(driver_id)
-                if driver:
-                    await session.delete(driver)
-                    await session.commit()
-                    await update.message.reply_text("✅ Водитель успешно удален")
-                else:
-                    await update.message.reply_text("❌ Водитель не найден")
+            if await delete_driver(driver_id):
+                await update.message.reply_text("✅ Водитель успешно удален")
+            else:
+                await update.message.reply_text("❌ Водитель не найден")
         except ValueError:
             await update.message.reply_text("❌ Неверный формат ID")
+        except Exception as e:
+            logger.error("Error deleting driver %s: %s", update.message.text, e)
+            await update.message.reply_text("❌ Не удалось удалить водителя")
         finally:
             context.user_data.clear()
 
 # Order handling
+@timed_handler
 async def handle_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle new order messages in the group"""
-    # Log incoming message
-    logger.info(f"Received message in chat {update.message.chat.id}: {update.message.text}")
+    """Handle new order messages in the group.
+
+    Only messages from the order group that the classifier takes for an
+    order get here, see the handler filters in main().
+    """
+    logger.info(Event('order_message', chat=update.message.chat.id, message=update.message.message_id))
+    order_id = await db.create_order(
+        update.message.chat.id, update.message.message_id, update.message.text
+    )
+    if order_id is None:
+        return  # the same message again, e.g. a redelivered update
     
-    try:
-        group_id = int(GROUP_ID) if GROUP_ID else None
-    except ValueError:
-        logger.error(f"Invalid GROUP_ID format: {GROUP_ID}")
-        return
-        
-    if not group_id or update.message.chat.id != group_id:
-        logger.info(f"Message from wrong chat. Expected {group_id}, got {update.message.chat.id}")
+    # Reserve the first drivers without an open offer in the group's zone
+    zone = zone_for_chat(update.message.chat.id)
+    drivers = dispatcher_for(zone).claim_top(order_id, broadcast_size(update.message.chat.id))
+    
+    if not drivers:
+        logger.info(Event('order_unassigned', order=order_id, reason='queue_empty'))
+        ORDERS_TOTAL.inc('unassigned')
+        await db.set_order_status(order_id, 'unassigned')
+        await update.message.reply_text(
+            "❌ К сожалению, сейчас нет свободных водителей"
+        )
         return
 
-    # Check if message contains order keywords
-    order_keywords = ['заказ', 'поездка', 'нужно', 'такси']
-    message_text = update.message.text.lower()
-    
-    if any(keyword in message_text for keyword in order_keywords):
-        logger.info("Order keywords found in message")
-        
-        # Get first driver in queue
-        driver = await db.get_first_in_queue()
-        
-        if not driver:
-            logger.info("No available drivers in queue")
-            await update.message.reply_text(
-                "❌ К сожалению, сейчас нет свободных водителей"
-            )
-            return
+    order = OrderRecord(
+        order_id, zone, update.message.chat.id, update.message.text, update.message.message_id
+    )
+    try:
+        # Register the order before sending messages
+        evicted = orders.add(order)
+        if evicted:
+            await drop_orders(evicted, 'max_open_orders')
+        logger.info(Event('order_created', order=order_id, chat=update.message.chat.id, zone=zone))
 
-        # Send confirmation to group
+        # Offers go out before the group hears anything, group messages wait for
+        # the group's rate limit and would hold the offers up behind them
+        sent = await send_offers(context, order_id, drivers)
+    except Exception:
+        # Don't leave the drivers reserved, or the order pending for recover_orders
+        await abandon_order(order, drivers)
+        raise
+    if not sent:
+        orders.remove(order_id)  # Clean up on error
+        ORDERS_TOTAL.inc('unassigned')
+        await db.set_order_status(order_id, 'unassigned')
+        await update.message.reply_text(
+            "❌ Произошла ошибка при отправке заказа водителю"
+        )
+        return
+
+    # Send confirmation to group, unless a driver took the order already
+    if order_id in orders:
         await update.message.reply_text("✅ Поехали!")
-        logger.info(f"Order confirmation sent to group")
 
-        # Create inline keyboard for driver
-        keyboard = [
-            [InlineKeyboardButton("🚗 Принять заказ", callback_data=f"accept_order_{update.message.message_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        # Store order info in context before sending message
-        order_key = f'order_{update.message.message_id}'
-        if not hasattr(context, 'bot_data'):
-            context.bot_data = {}
-        context.bot_data[order_key] = {
-            'driver_id': driver.telegram_id,
-            'chat_id': update.message.chat.id,
-            'text': update.message.text,
-            'original_message_id': update.message.message_id,
-            'status': 'pending'
-        }
-        logger.info(f"Order data stored in context: {context.bot_data[order_key]}")
+async def abandon_order(order: OrderRecord, drivers: list):
+    """Close an order whose dispatch failed halfway, freeing the drivers claimed for it"""
+    if order.status not in ('pending', 'offered'):
+        return  # accepted or dropped meanwhile, closed by whoever did that
+    order.status = 'expired'
+    timers.cancel(order.id)
+    claimed = set(drivers).union(orders.clear_offers(order))
+    orders.remove(order.id)
+    dispatcher = dispatcher_for(order.zone)
+    for driver_id in claimed:
+        dispatcher.release(order.id, driver_id)
+    ORDERS_TOTAL.inc('unassigned')
+    logger.warning(Event('order_unassigned', order=order.id, reason='dispatch_failed'))
+    try:
+        await db.set_order_status(order.id, 'unassigned')
+    except Exception as e:
+        logger.error("Error closing order %s: %s", order.id, e)
 
-        try:
-            # Send order to driver
-            sent_message = await context.bot.send_message(
-                chat_id=driver.telegram_id,
-                text=(
-                    "🚨 Есть заказ!\n\n"
-                    f"Текст заказа:\n{update.message.text}\n\n"
-                    "У вас есть 30 секунд, чтобы принять заказ!"
-                ),
-                reply_markup=reply_markup
-            )
-            logger.info(f"Order sent to driver {driver.telegram_id}")
-            
-            # Update order info with sent message id
-            context.bot_data[order_key]['message_id'] = sent_message.message_id
-            
-            # Set timer for order expiration
-            asyncio.create_task(
-                handle_order_timeout(
-                    context,
-                    update.message.message_id,
-                    driver.telegram_id,
-                    sent_message.message_id
-                )
-            )
-            logger.info(f"Order timeout task created for order {update.message.message_id}")
-            
-        except Exception as e:
-            logger.error(f"Error sending order to driver: {e}")
-            del context.bot_data[order_key]  # Clean up on error
-            await update.message.reply_text(
-                "❌ Произошла ошибка при отправке заказа водителю"
-            )
-    else:
-        logger.debug(f"No order keywords found in message: {message_text}")
+async def send_offers(context: ContextTypes.DEFAULT_TYPE, order_id: int, drivers: list):
+    """Send one round of offers to the reserved drivers and start its timeout.
+
+    All drivers of a round share one deadline. Returns False if no offer
+    could be sent.
+    """
+    order = orders.get(order_id)
+    order.round += 1
+    order.status = 'offered'
+    order.sending = True
+    timeout = offer_timeout(order.chat_id)
+    try:
+        sent = await asyncio.gather(*(
+            send_offer(context, order, driver_id, timeout) for driver_id in drivers
+        ))
+    finally:
+        order.sending = False
+
+    if order.status != 'offered':
+        return True  # accepted while the other offers were still going out
+    if not any(sent):
+        return False
+    timers.schedule(
+        order_id, timeout, handle_order_timeout, context, order_id, order.round
+    )
+    logger.info(Event('order_offered', order=order_id, drivers=len(order.offers), timeout=timeout))
+    if not order.offers:
+        # Everybody declined before the last offer went out
+        timers.cancel(order_id)
+        await pass_to_next_driver(context, order_id)
+    return True
+
+async def send_offer(context: ContextTypes.DEFAULT_TYPE, order: OrderRecord, driver_id: int, timeout: int):
+    """Send the order to one reserved driver, returns False if that failed"""
+    order_id = order.id
+    keyboard = [
+        [InlineKeyboardButton("🚗 Принять заказ", callback_data=ACCEPT_ORDER.data(order_id))],
+        [InlineKeyboardButton("❌ Отказаться", callback_data=DECLINE_ORDER.data(order_id))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    try:
+        sent_message = await context.bot.send_message(
+            chat_id=driver_id,
+            text=(
+                "🚨 Есть заказ!\n\n"
+                f"Текст заказа:\n{order.text}\n\n"
+                f"У вас есть {timeout} секунд, чтобы принять заказ!"
+            ),
+            reply_markup=reply_markup,
+            rate_limit_args=URGENT
+        )
+    except Exception as e:
+        logger.error("Error sending order to driver: %s", e)
+        OFFERS_TOTAL.inc('failed')
+        dispatcher_for(order.zone).release(order_id, driver_id)
+        order.skipped.add(driver_id)
+        return False
+    logger.debug(Event('offer_sent', order=order_id, driver=driver_id))
+
+    if order.status != 'offered' or not orders.add_offer(order, driver_id, sent_message.message_id):
+        # Another driver of this round took the order while this one was in flight
+        OFFERS_TOTAL.inc('withdrawn')
+        dispatcher_for(order.zone).release(order_id, driver_id)
+        await withdraw_offer(context, driver_id, sent_message.message_id)
+        return False
+
+    order.offers_sent += 1
+    OFFERS_TOTAL.inc('sent')
+    await db.record_offer(
+        order_id, driver_id, sent_message.message_id,
+        datetime.utcnow() + timedelta(seconds=timeout)
+    )
+    return True
 
-async def handle_order_timeout(context: ContextTypes.DEFAULT_TYPE, order_id: int, driver_id: int, message_id: int):
-    """Handle order timeout after 30 seconds"""
-    logger.info(f"Starting timeout handler for order {order_id}")
-    await asyncio.sleep(30)
+async def withdraw_offer(context: ContextTypes.DEFAULT_TYPE, driver_id: int, message_id: int):
+    """Tell a driver their offer is gone because someone else accepted first"""
+    try:
+        await context.bot.edit_message_text(
+            chat_id=driver_id,
+            message_id=message_id,
+            text="🚫 Заказ уже забрал другой водитель",
+            rate_limit_args=URGENT
+        )
+    except Exception as e:
+        logger.error("Error withdrawing offer from driver %s: %s", driver_id, e)
+
+async def pass_to_next_driver(context: ContextTypes.DEFAULT_TYPE, order_id: int):
+    """Offer an order nobody took to the next free drivers who haven't seen it yet"""
+    order = orders.get(order_id)
+    if order is None:
+        return  # closed by drop_orders in the meantime
+    drivers = dispatcher_for(order.zone).claim_top(
+        order_id, broadcast_size(order.chat_id), exclude=order.skipped
+    )
+    if drivers:
+        logger.info(Event('order_passed', order=order_id, drivers=tuple(drivers)))
+        if await send_offers(context, order_id, drivers):
+            return
     
+    logger.info(Event('order_unassigned', order=order_id, reason='no_drivers_left'))
+    orders.remove(order_id)
+    ORDERS_TOTAL.inc('unassigned')
+    OFFERS_PER_ORDER.observe(order.offers_sent)
+    await db.set_order_status(order_id, 'unassigned')
+    await context.bot.send_message(
+        chat_id=order.chat_id,
+        reply_to_message_id=order.message_id,
+        text="❌ К сожалению, свободных водителей больше нет"
+    )
+
+async def handle_order_timeout(context: ContextTypes.DEFAULT_TYPE, order_id: int, round_number: int):
+    """Handle a round of offers nobody accepted in time"""
     # Check if order still exists and wasn't accepted
-    order_data = context.bot_data.get(f'order_{order_id}')
-    if order_data and order_data['driver_id'] == driver_id:
-        logger.info(f"Order {order_id} timed out for driver {driver_id}")
-        # Remove order data
-        del context.bot_data[f'order_{order_id}']
+    order = orders.get(order_id)
+    if order and order.round == round_number and order.status == 'offered':
+        expired = orders.clear_offers(order)
+        logger.info(Event('offers_expired', order=order_id, drivers=tuple(expired)))
+        order.status = 'pending'
+        order.skipped.update(expired)
+        OFFERS_TOTAL.inc('expired', amount=len(expired))
+        dispatcher = dispatcher_for(order.zone)
+        for driver_id in expired:
+            dispatcher.release(order_id, driver_id)
+            await db.close_offer(order_id, driver_id, 'expired')
+            await penalize_missed_offer(dispatcher, driver_id)
         
+        # Pass order to next drivers before telling anyone, see handle_order
         try:
-            # Edit message to driver
-            await context.bot.edit_message_text(
+            await pass_to_next_driver(context, order_id)
+        except Exception as e:
+            logger.error("Error passing order %s on after timeout: %s", order_id, e)
+
+        # Edit messages to drivers and tell the group, unless it already
+        # heard that nobody is left; one failed notice doesn't stop the rest
+        notices = [
+            context.bot.edit_message_text(
                 chat_id=driver_id,
                 message_id=message_id,
                 text="⏰ Время на принятие заказа истекло"
             )
-            
-            # Send message to group
-            await context.bot.send_message(
-                chat_id=order_data['chat_id'],
-                reply_to_message_id=order_data['original_message_id'],
-                text="⏰ Водитель не успел принять заказ, ищем следующего..."
-            )
-            
-            # Pass order to next driver
-            driver = await db.get_first_in_queue()
-            if driver:
-                logger.info(f"Passing order to next driver {driver.telegram_id}")
-                keyboard = [
-                    [InlineKeyboardButton("🚗 Принять заказ", callback_data=f"accept_order_{order_id}")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                sent_message = await context.bot.send_message(
-                    chat_id=driver.telegram_id,
-                    text=(
-                        "🚨 Есть заказ!\n\n"
-                        f"Текст заказа:\n{order_data['text']}\n\n"
-                        "У вас есть 30 секунд, чтобы принять заказ!"
-                    ),
-                    reply_markup=reply_markup
-                )
-                
-                # Update order info in context
-                context.bot_data[f'order_{order_id}'] = {
-                    'driver_id': driver.telegram_id,
-                    'message_id': sent_message.message_id,
-                    'original_message_id': order_data['original_message_id'],
-                    'chat_id': order_data['chat_id'],
-                    'text': order_data['text']
-                }
-                
-                # Set new timer
-                asyncio.create_task(
-                    handle_order_timeout(
-                        context,
-                        order_id,
-                        driver.telegram_id,
-                        sent_message.message_id
-                    )
-                )
-            else:
-                logger.info("No more drivers available in queue")
-                await context.bot.send_message(
-                    chat_id=order_data['chat_id'],
-                    reply_to_message_id=order_data['original_message_id'],
-                    text="❌ К сожалению, свободных водителей больше нет"
+            for driver_id, message_id in expired.items()
+        ]
+        if order_id in orders:
+            notices.append(context.bot.send_message(
+                chat_id=order.chat_id,
+                reply_to_message_id=order.message_id,
+                text=(
+                    "⏰ Водитель не успел принять заказ, ищем следующего..." if len(expired) == 1
+                    else "⏰ Водители не успели принять заказ, ищем следующих..."
                 )
-                
-        except Exception as e:
-            logger.error(f"Error handling order timeout: {e}")
+            ))
+        for result in await asyncio.gather(*notices, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Error sending timeout notice for order %s: %s", order_id, result)
     else:
-        logger.info(f"Order {order_id} was already accepted or cancelled")
+        logger.debug(Event('order_timeout_ignored', order=order_id, round=round_number))
 
-async def accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle order acceptance by driver"""
+async def penalize_missed_offer(dispatcher: OrderDispatcher, driver_id: int):
+    """Move a driver to the back of their zone's queue after too many missed offers"""
+    if not MISSED_OFFERS_LIMIT:
+        return
+    if dispatcher.record_miss(driver_id) >= MISSED_OFFERS_LIMIT:
+        dispatcher.reset_misses(driver_id)
+        if await db.move_to_back(driver_id):
+            logger.info(Event('driver_moved_back', driver=driver_id, reason='missed_offers'))
+
+async def drop_orders(records, reason: str):
+    """Close orders that left the registry without being taken, freeing their drivers"""
+    for order in records:
+        order.status = 'expired'
+        timers.cancel(order.id)
+        dispatcher = dispatcher_for(order.zone)
+        for driver_id in orders.clear_offers(order):
+            dispatcher.release(order.id, driver_id)
+    order_ids = [order.id for order in records]
+    await db.expire_orders(order_ids)
+    ORDERS_TOTAL.inc('expired', amount=len(order_ids))
+    logger.warning(Event('orders_dropped', reason=reason, orders=tuple(order_ids)))
+
+async def sweep_orders():
+    """Close orders that have been open longer than ORDER_MAX_AGE, runs periodically"""
+    try:
+        stale = orders.expired()
+        if stale:
+            await drop_orders(stale, 'max_age')
+    finally:
+        timers.schedule(ORDER_SWEEP, ORDER_SWEEP_INTERVAL, sweep_orders)
+
+@timed_handler
+async def decline_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle a driver turning an offer down"""
     query = update.callback_query
-    order_id = int(query.data.split('_')[-1])
-    logger.info(f"Driver {query.from_user.id} attempting to accept order {order_id}")
+    order_id, = context.args
+    order = orders.get(order_id)
     
-    # Check if order exists in bot_data
-    order_key = f'order_{order_id}'
-    order_data = context.bot_data.get(order_key)
+    if (not order or order.status != 'offered'
+            or orders.offer_for(query.from_user.id) != order_id):
+        await query.answer("❌ Этот заказ уже не актуален", show_alert=True)
+        return
     
-    logger.info(f"Order data from context: {order_data}")
+    logger.info(Event('offer_declined', order=order_id, driver=query.from_user.id))
+    orders.remove_offer(order, query.from_user.id)
+    dispatcher_for(order.zone).release(order_id, query.from_user.id)
+    order.skipped.add(query.from_user.id)
+    OFFERS_TOTAL.inc('declined')
+    # The round goes on while other drivers still have the offer
+    round_over = not order.offers and not order.sending
+    if round_over:
+        timers.cancel(order_id)
+        order.status = 'pending'
+    await query.answer()
+    await db.close_offer(order_id, query.from_user.id, 'declined')
     
-    if not order_data or order_data.get('status') != 'pending':
-        logger.warning(f"Order {order_id} not found or not pending. Data: {order_data}")
+    if round_over:
+        try:
+            await pass_to_next_driver(context, order_id)
+        except Exception as e:
+            logger.error("Error passing declined order %s on: %s", order_id, e)
+    try:
+        await query.edit_message_text("❌ Вы отказались от заказа")
+    except Exception as e:
+        logger.error("Error editing declined offer of order %s: %s", order_id, e)
+
+@timed_handler
+async def accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle order acceptance by driver.
+
+    When an order went out to several drivers the first accept wins: the
+    status flips before the first await, so later accepts see the order as
+    taken, and the other drivers' offers are withdrawn.
+    """
+    query = update.callback_query
+    order_id, = context.args
+    logger.debug(Event('accept_attempt', order=order_id, driver=query.from_user.id))
+    
+    order = orders.get(order_id)
+    
+    if not order or order.status != 'offered':
+        logger.warning(Event('accept_rejected', order=order_id, driver=query.from_user.id, reason='not_open'))
         await query.answer("❌ Этот заказ уже не актуален", show_alert=True)
         return
         
-    if order_data['driver_id'] != query.from_user.id:
-        logger.warning(f"Wrong driver trying to accept order. Expected {order_data['driver_id']}, got {query.from_user.id}")
+    if orders.offer_for(query.from_user.id) != order_id:
+        logger.warning(Event('accept_rejected', order=order_id, driver=query.from_user.id, reason='not_offered'))
         await query.answer("❌ Этот заказ предназначен другому водителю", show_alert=True)
         return
     
+    # Mark order as accepted before the first await so neither the timeout
+    # nor another driver of the round can take it in between
+    order.status = 'accepted'
+    timers.cancel(order_id)
+    dispatcher = dispatcher_for(order.zone)
+    
     try:
-        # Get driver info
-        driver = await db.get_driver(query.from_user.id)
+        # Remove from queue, mark busy, record the order and withdraw the
+        # other offers in one transaction
+        driver = await db.assign_order(query.from_user.id, order_id)
         if not driver:
-            logger.error(f"Driver {query.from_user.id} not found in database")
-            await query.answer("❌ Ошибка: водитель не найден", show_alert=True)
-            return
-        
-        # Remove from queue and update status
-        if not await db.remove_from_queue(query.from_user.id):
-            logger.error(f"Failed to remove driver {query.from_user.id} from queue")
+            logger.error(Event('order_assign_failed', order=order_id, driver=query.from_user.id))
+            orders.remove_offer(order, query.from_user.id)
+            dispatcher.release(order_id, query.from_user.id)
+            order.skipped.add(query.from_user.id)
+            await db.close_offer(order_id, query.from_user.id, 'declined')
             await query.answer("❌ Ошибка: не удалось обновить очередь", show_alert=True)
+            if order.offers:
+                # Let the rest of the round run out, restarting its timer
+                order.status = 'offered'
+                timers.schedule(
+                    order_id, offer_timeout(order.chat_id), handle_order_timeout,
+                    context, order_id, order.round
+                )
+            else:
+                order.status = 'pending'
+                await pass_to_next_driver(context, order_id)
             return
-        
-        # Mark order as accepted
-        order_data['status'] = 'accepted'
-        
-        # Edit message to driver
-        await query.edit_message_text(
-            f"✅ Вы приняли заказ!\n\n"
-            f"Текст заказа:\n{order_data['text']}\n\n"
-            "Не забудьте нажать «Отбиться» после выполнения заказа!"
-        )
-        
-        # Send confirmation to group
+    except Exception as e:
+        logger.error("Error accepting order: %s", e)
+        await query.answer("❌ Произошла ошибка при принятии заказа", show_alert=True)
+        return
+
+    # Order is taken, nothing else to wait for. The assignment is committed,
+    # so from here on a failed message is logged, not reported to the driver.
+    orders.remove(order_id)
+    losers = {d: m for d, m in order.offers.items() if d != driver.telegram_id}
+    for driver_id in order.offers:
+        dispatcher.release(order_id, driver_id)
+    dispatcher.reset_misses(driver.telegram_id)
+    ORDERS_TOTAL.inc('accepted')
+    OFFERS_TOTAL.inc('accepted')
+    OFFERS_TOTAL.inc('withdrawn', amount=len(losers))
+    OFFERS_PER_ORDER.observe(order.offers_sent)
+    TIME_TO_ACCEPT.observe(time.monotonic() - order.created)
+    logger.info(Event('order_accepted', order=order_id, driver=driver.telegram_id))
+
+    # Confirm to the driver and withdraw the other offers at once, ahead of
+    # any menu updates. The group hears last, see handle_order.
+    confirmation, *_ = await asyncio.gather(
+        context.bot.edit_message_text(
+            chat_id=query.message.chat_id,
+            message_id=query.message.message_id,
+            text=(
+                f"✅ Вы приняли заказ!\n\n"
+                f"Текст заказа:\n{order.text}\n\n"
+                "Не забудьте нажать «Отбиться» после выполнения заказа!"
+            ),
+            rate_limit_args=URGENT
+        ),
+        *(withdraw_offer(context, driver_id, message_id) for driver_id, message_id in losers.items()),
+        return_exceptions=True
+    )
+    if isinstance(confirmation, Exception):
+        logger.error("Error confirming order %s to driver %s: %s", order_id, driver.telegram_id, confirmation)
+
+    try:
         await context.bot.send_message(
-            chat_id=order_data['chat_id'],
-            reply_to_message_id=order_data['original_message_id'],
-            text=f"✅ Забирает {driver.car_model} с госномером {driver.car_number}"
+            chat_id=order.chat_id,
+            reply_to_message_id=order.message_id,
+            text=f"✅ Забирает {driver.car_model} с госномером {driver.car_number}",
+            rate_limit_args=URGENT
         )
-        
-        logger.info(f"Order {order_id} successfully accepted by driver {driver.telegram_id}")
-        
     except Exception as e:
-        logger.error(f"Error accepting order: {e}")
-        await query.answer("❌ Произошла ошибка при принятии заказа", show_alert=True)
-    finally:
-        # Clean up order data after processing
-        if order_data['status'] == 'accepted':
-            del context.bot_data[order_key]
+        logger.error("Error announcing order %s to the group: %s", order_id, e)
+
+async def recover_orders(application: Application):
+    """Resume dispatch for orders that were still open when the bot stopped"""
+    started = time.perf_counter()
+    context = CallbackContext(application)
+    now = datetime.utcnow()
+    open_orders = await db.get_open_orders()
+    stale, resumed, to_dispatch, evicted = [], 0, [], []
+
+    for order, offers in open_orders:
+        if (now - order.created_at).total_seconds() > ORDER_MAX_AGE:
+            stale.append(order.id)
+            continue
+
+        record = OrderRecord(
+            order.id, zone_for_chat(order.chat_id), order.chat_id, order.text, order.message_id,
+            created=time.monotonic() - (now - order.created_at).total_seconds()
+        )
+        record.round = 1
+        record.skipped = {o.driver_telegram_id for o in offers if o.status != 'offered'}
+        record.offers_sent = len(offers)
+        evicted.extend(orders.add(record))
+
+        # The offers of the last round that are still out there
+        deadline = None
+        for offer in offers:
+            if offer.status != 'offered':
+                continue
+            if dispatcher_for(record.zone).claim(order.id, offer.driver_telegram_id):
+                orders.add_offer(record, offer.driver_telegram_id, offer.message_id)
+                deadline = max(deadline or offer.deadline, offer.deadline)
+            else:
+                await db.close_offer(order.id, offer.driver_telegram_id, 'expired')
+                record.skipped.add(offer.driver_telegram_id)
+
+        if record.offers:
+            # Give the drivers whatever time is left
+            record.status = 'offered'
+            timers.schedule(
+                order.id, max(0.0, (deadline - now).total_seconds()), handle_order_timeout,
+                context, order.id, record.round
+            )
+            resumed += 1
+        else:
+            to_dispatch.append(order.id)
+
+    await db.expire_orders(stale)
+    ORDERS_TOTAL.inc('expired', amount=len(stale))
+    if evicted:
+        await drop_orders(evicted, 'max_open_orders')
+    logger.info(
+        "Recovered %s offers and %s orders to dispatch, expired %s in %.1f ms",
+        resumed, len(to_dispatch), len(stale), (time.perf_counter() - started) * 1000
+    )
+    timers.schedule(ORDER_SWEEP, ORDER_SWEEP_INTERVAL, sweep_orders)
+    for order_id in to_dispatch:
+        try:
+            await pass_to_next_driver(context, order_id)
+        except Exception as e:
+            logger.error("Error resuming order %s: %s", order_id, e)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Log Errors caused by Updates."""
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
     try:
         if update and update.effective_message:
             await update.effective_message.reply_text(
                 "❌ Произошла ошибка при обработке команды. Пожалуйста, попробуйте позже."
             )
     except Exception as e:
-        logger.error(f"Error in error handler: {e}")
+        logger.error("Error in error handler: %s", e)
 
-async def update_menu_message(message, user_id: int):
-    """Update existing menu message with new keyboard"""
-    reply_markup = await get_main_menu(user_id)
+async def update_menu_message(message, reply_markup, text="Выберите действие:"):
+    """Update existing menu message with new keyboard, unless it already shows it"""
+    key = (message.chat_id, message.message_id)
+    # The message in the update may predate our last edit, what we sent last wins
+    shown = shown_menus.pop(key, None) or (message.text, message.reply_markup)
+    shown_menus[key] = (text, reply_markup)
+    if len(shown_menus) > MAX_SHOWN_MENUS:
+        del shown_menus[next(iter(shown_menus))]
+    if shown == (text, reply_markup):
+        MENU_EDITS_SKIPPED.inc()
+        return
     try:
         await message.edit_text(
-            "Выберите действие:",
+            text,
             reply_markup=reply_markup
         )
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            shown_menus.pop(key, None)
+            logger.error("Error updating menu: %s", e)
     except Exception as e:
-        logger.error(f"Error updating menu: {e}")
+        shown_menus.pop(key, None)
+        logger.error("Error updating menu: %s", e)
+
+# Handlers that change the queue or an order. With worker processes only the
+# coordinator runs them, so queue order and the accept race stay in one process.
+# /loglevel runs there too and passes new levels on to the workers.
+QUEUE_HANDLERS = [
+    CommandHandler("stats", stats),
+    CommandHandler("loglevel", log_level),
+    CallbackRouter({
+        JOIN_QUEUE: join_queue,
+        LEAVE_QUEUE: leave_queue,
+        ADMIN_RESET_QUEUE: admin_reset_queue,
+        ACCEPT_ORDER: accept_order,
+        DECLINE_ORDER: decline_order,
+    }, taps=taps),
+    # Messages from other chats and non-orders are dropped by the filters
+    MessageHandler(
+        filters.TEXT & filters.Chat(chat_id=ORDER_CHAT_IDS) & OrderMessageFilter(order_classifier),
+        handle_order
+    ),
+]
 
-async def main():
-    """Start the bot"""
-    # Initialize database
-    await db.init_db()
-    logger.info("Database initialized")
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Hand updates that don't touch the queue or an order to the user's worker.
+
+    Runs ahead of all other handlers in the coordinator. If the worker is
+    not connected the update is handled here.
+    """
+    if any(handler.check_update(update) for handler in QUEUE_HANDLERS):
+        return
+    if await coordinator.forward(update, worker_for(update, WORKERS)):
+        raise ApplicationHandlerStop
+
+async def stop_workers(application: Application):
+    """Stop the worker processes, then the socket they talk to"""
+    await workers.stop()
+    await coordinator.stop()
+
+async def shutdown(application: Application):
+    """Stop the order timers, then the worker processes if there are any"""
+    await timers.stop()
+    if WORKERS:
+        await stop_workers(application)
+
+async def main(worker_index=None):
+    """Start the bot, or with worker_index one of its worker processes"""
+    global coordinator, workers
+    if worker_index is None:
+        # Initialize database
+        await db.init_db()
+        logger.info("Database initialized")
+    else:
+        # The coordinator loads the queue and streams every change to the workers
+        db.owns_queue = False
+    if WORKERS:
+        # The global Bot API limit is per bot, every process gets its share
+        outbound.global_rate /= WORKERS + 1
 
     # Create application
-    application = Application.builder().token(TOKEN).build()
+    # Every Bot API call goes through the outbound limiter, order offers first
+    builder = Application.builder().token(TOKEN).rate_limiter(outbound)
+    if worker_index is None:
+        builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES)).post_init(recover_orders)
+        builder.post_shutdown(shutdown)
+    else:
+        # Updates come from the coordinator, which also keeps each user's in order
+        builder.updater(None)
+    if TELEGRAM_API_URL:
+        builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+    if TRACE_SLOW_MS > 0:
+        builder.application_class(TracingApplication, kwargs={'slow_threshold': TRACE_SLOW_MS / 1000})
+    # With workers, user_data lives in the workers; the coordinator's own handlers never
+    # use it, loading it here would cost a read for every update it forwards
+    if PERSISTENCE_INTERVAL > 0 and not (worker_index is None and WORKERS):
+        # Open orders live in the order registry and are rebuilt from the orders tables
+        # by recover_orders, bot_data is not used. Neither is chat_data, skipping it
+        # saves a read on every new chat.
+        builder.persistence(SQLitePersistence(
+            db,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=PERSISTENCE_INTERVAL
+        ))
+    application = builder.build()
+    REGISTRY.add_collector(lambda: collect_gauges(application))
+    if METRICS_PORT:
+        # Each process serves its own metrics, workers on the ports after METRICS_PORT
+        port = METRICS_PORT if worker_index is None else METRICS_PORT + 1 + worker_index
+        await metrics.start_server(METRICS_HOST, port)
     logger.info("Application created")
 
     # Add handlers
@@ -620,24 +1239,14 @@ async def main():
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("admin", admin))
     
-    # Add callback query handlers
-    application.add_handler(CallbackQueryHandler(register_driver, pattern="^register$"))
-    application.add_handler(CallbackQueryHandler(join_queue, pattern="^join_queue$"))
-    application.add_handler(CallbackQueryHandler(leave_queue, pattern="^leave_queue$"))
-    application.add_handler(CallbackQueryHandler(show_profile, pattern="^profile$"))
-    
-    # Add admin callback query handlers
-    application.add_handler(CallbackQueryHandler(admin_drivers_list, pattern="^admin_drivers_list$"))
-    application.add_handler(CallbackQueryHandler(admin_queue_list, pattern="^admin_queue_list$"))
-    application.add_handler(CallbackQueryHandler(admin_reset_queue, pattern="^admin_reset_queue$"))
-    application.add_handler(CallbackQueryHandler(admin_delete_driver, pattern="^admin_delete_driver$"))
-    
-    # Add order handlers
-    application.add_handler(CallbackQueryHandler(accept_order, pattern="^accept_order_"))
-    application.add_handler(MessageHandler(
-        filters.TEXT & filters.ChatType.GROUPS,
-        handle_order
-    ))
+    # Add callback query handlers, the queue and order ones are in QUEUE_HANDLERS
+    application.add_handler(CallbackRouter({
+        REGISTER: register_driver,
+        PROFILE: show_profile,
+        ADMIN_DRIVERS_LIST: admin_drivers_list,
+        ADMIN_QUEUE_LIST: admin_queue_list,
+        ADMIN_DELETE_DRIVER: admin_delete_driver,
+    }, taps=taps))
     
     # Add message handler for registration process
     application.add_handler(MessageHandler(
@@ -645,12 +1254,86 @@ async def main():
         handle_registration_input
     ))
 
+    # Add queue and order handlers
+    if worker_index is None:
+        application.add_handlers(QUEUE_HANDLERS)
+
     # Add error handler
     application.add_error_handler(error_handler)
 
+    if worker_index is None and WORKERS:
+        # Queue changes the workers' handlers need are made here
+        coordinator = Coordinator(db.queue, COORDINATOR_SOCKET, calls={'delete_driver': db.delete_driver})
+        await coordinator.start()
+        application.add_handler(TypeHandler(Update, route_update), group=-1)
+        workers = WorkerPool(WORKERS, run_worker)
+        workers.start()
+
     logger.info("Starting bot...")
     return application
 
+async def start_webhook(application: Application):
+    """Serve the webhook and point Telegram at it, returns the server"""
+    server = WebhookServer(application, WEBHOOK_SECRET, urlparse(WEBHOOK_URL).path or '/')
+    await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    allowed_updates = allowed_updates_for(application)
+    await application.bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_updates,
+        max_connections=WEBHOOK_MAX_CONNECTIONS
+    )
+    logger.info("Webhook set to %s for %s", WEBHOOK_URL, allowed_updates)
+    return server
+
+async def run_webhook(application: Application):
+    """Run the application on webhook updates until SIGINT or SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows, Ctrl+C still raises KeyboardInterrupt
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        server = await start_webhook(application)
+        await application.start()
+        try:
+            await stop.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+async def serve_worker(index: int):
+    """Handle the updates the coordinator hands over until it goes away or SIGTERM"""
+    global worker_client
+    application = await main(worker_index=index)
+    client = worker_client = WorkerClient(db.queue, COORDINATOR_SOCKET, index)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    async with application:
+        await application.start()
+        try:
+            await client.run(
+                lambda data: application.process_update(Update.de_json(data, application.bot))
+            )
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await application.stop()
+    await db.close()
+    logger.info("Worker %s stopped", index)
+
+def run_worker(index: int):
+    """Entry point of a worker process, started by the coordinator"""
+    # Ctrl+C reaches the whole process group, the coordinator stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(index))
+
 def run_bot():
     """Run the bot."""
     # Set up asyncio policies for Windows
@@ -668,18 +1351,21 @@ def run_bot():
         logger.info("Bot started successfully!")
         logger.info("Press Ctrl+C to stop the bot")
         
-        # Start polling
-        loop.run_until_complete(
-            application.run_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
+        if WEBHOOK_URL:
+            loop.run_until_complete(run_webhook(application))
+        else:
+            # Start polling, only for the update types there are handlers for
+            loop.run_until_complete(
+                application.run_polling(
+                    allowed_updates=allowed_updates_for(application),
+                    drop_pending_updates=False
+                )
             )
-        )
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
         loop.run_until_complete(application.stop())
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
+        logger.error("Fatal error: %s", e)
         if 'application' in locals():
             loop.run_until_complete(application.stop())
     finally:
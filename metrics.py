@@ -0,0 +1,250 @@
+"""In-process metrics with a Prometheus text endpoint.
+
+Metrics are plain counters and fixed-bucket histograms kept in dicts, so
+recording one is a dict lookup and an addition and they can stay on in
+production. Gauges are set by collectors that run right before each scrape.
+"""
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+from tracing import CURRENT_TRACE
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast cached lookup up to a slow Bot API round trip
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic count per label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, labels, '', value
+
+
+class Gauge(Counter):
+    """Current value per label values"""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class _HistogramChild:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size  # per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Distribution over fixed upper bounds per label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._children = {}
+
+    def observe(self, value, *labels):
+        child = self._children.get(labels)
+        if child is None:
+            child = self._children[labels] = _HistogramChild(len(self.buckets) + 1)
+        child.counts[bisect_left(self.buckets, value)] += 1
+        child.sum += value
+        child.count += 1
+
+    def count(self, *labels):
+        child = self._children.get(labels)
+        return child.count if child else 0
+
+    def quantile(self, q, *labels):
+        """Estimate a quantile by interpolating inside its bucket, None without data"""
+        child = self._children.get(labels)
+        if not child or not child.count:
+            return None
+        rank = q * child.count
+        seen = 0
+        for i, bucket_count in enumerate(child.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def label_values(self):
+        return sorted(self._children)
+
+    def samples(self):
+        for labels, child in sorted(self._children.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket', labels, f'le="{le}"', cumulative
+            yield f'{self.name}_sum', labels, '', child.sum
+            yield f'{self.name}_count', labels, '', child.count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """Register ``async collector()`` to refresh gauges before a scrape or summary"""
+        self._collectors.append(collector)
+
+    async def collect(self):
+        for collector in self._collectors:
+            try:
+                await collector()
+            except Exception as e:
+                logger.error("Error in metrics collector: %s", e)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, extra, value in metric.samples():
+                lines.append(f'{name}{_format_labels(metric.labelnames, labels, extra)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'taxi_bot_handler_seconds', 'Time spent in update handlers', ('handler',)
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    'taxi_bot_handler_errors_total', 'Update handlers that raised', ('handler',)
+)
+DB_SECONDS = REGISTRY.histogram(
+    'taxi_bot_db_seconds', 'Time spent in Database methods', ('method',)
+)
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    'taxi_bot_loop_lag_seconds', 'How late the event loop woke up a sleeping task, only measured while tracing',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+
+def timed_handler(func):
+    """Record how long an update handler takes and whether it raised"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+def timed_query(func):
+    """Record how long a Database method takes, its histogram count is the call count.
+
+    Also a span of the traced update calling it, if there is one.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_SECONDS.observe(elapsed, name)
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.add('db', name, started, elapsed)
+    return wrapper
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Drain the headers, nothing in them matters here
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            await REGISTRY.collect()
+            body = REGISTRY.render().encode()
+            status = '200 OK'
+        else:
+            body = b'Not Found\n'
+            status = '404 Not Found'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning("Error serving metrics: %s", e)
+    finally:
+        writer.close()
+
+
+async def start_server(host, port):
+    """Serve GET /metrics on host:port in the running event loop"""
+    server = await asyncio.start_server(_handle_scrape, host, port)
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,207 @@
+"""Versioned schema migrations.
+
+Each migration is a (version, description, statements) entry in MIGRATIONS.
+``migrate`` applies the ones newer than the version recorded in the
+``schema_version`` table, each in its own transaction, so an existing
+database file is upgraded in place at startup. Never edit a migration that
+has shipped; add a new one instead.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER NOT NULL PRIMARY KEY,
+    description VARCHAR NOT NULL,
+    applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+MIGRATIONS = [
+    (1, 'initial schema', [
+        # Same DDL create_all used to emit, so old databases match it as is
+        """
+        CREATE TABLE IF NOT EXISTS drivers (
+            id INTEGER NOT NULL,
+            telegram_id INTEGER,
+            name VARCHAR,
+            car_model VARCHAR,
+            car_number VARCHAR,
+            status VARCHAR,
+            registration_date DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (telegram_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER NOT NULL,
+            driver_id INTEGER,
+            position INTEGER,
+            join_time DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(driver_id) REFERENCES drivers (id)
+        )
+        """,
+    ]),
+    (2, 'not null constraints, one queue row per driver, hot-path indexes', [
+        # drivers: rebuild with NOT NULL columns
+        "DELETE FROM drivers WHERE telegram_id IS NULL",
+        """
+        CREATE TABLE drivers_new (
+            id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            name VARCHAR NOT NULL,
+            car_model VARCHAR NOT NULL,
+            car_number VARCHAR NOT NULL,
+            status VARCHAR NOT NULL DEFAULT 'inactive',
+            registration_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id),
+            UNIQUE (telegram_id)
+        )
+        """,
+        """
+        INSERT INTO drivers_new (id, telegram_id, name, car_model, car_number, status, registration_date)
+        SELECT id, telegram_id, COALESCE(name, ''), COALESCE(car_model, ''), COALESCE(car_number, ''),
+               COALESCE(status, 'inactive'), COALESCE(registration_date, CURRENT_TIMESTAMP)
+        FROM drivers
+        """,
+        "DROP TABLE drivers",
+        "ALTER TABLE drivers_new RENAME TO drivers",
+        "CREATE INDEX ix_drivers_status ON drivers (status)",
+
+        # queue: drop orphaned and duplicate rows, make positions unique
+        """
+        DELETE FROM queue
+        WHERE driver_id IS NULL OR driver_id NOT IN (SELECT id FROM drivers)
+        """,
+        """
+        DELETE FROM queue
+        WHERE id NOT IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY driver_id ORDER BY position IS NULL, position, id
+                ) AS n
+                FROM queue
+            ) WHERE n = 1
+        )
+        """,
+        """
+        CREATE TABLE queue_new (
+            id INTEGER NOT NULL,
+            driver_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            join_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id),
+            FOREIGN KEY(driver_id) REFERENCES drivers (id)
+        )
+        """,
+        """
+        INSERT INTO queue_new (id, driver_id, position, join_time)
+        SELECT id, driver_id,
+               ROW_NUMBER() OVER (ORDER BY position IS NULL, position, id),
+               COALESCE(join_time, CURRENT_TIMESTAMP)
+        FROM queue
+        """,
+        "DROP TABLE queue",
+        "ALTER TABLE queue_new RENAME TO queue",
+        "CREATE UNIQUE INDEX ix_queue_driver_id ON queue (driver_id)",
+        "CREATE UNIQUE INDEX ix_queue_position ON queue (position)",
+    ]),
+    (3, 'orders and order offers', [
+        """
+        CREATE TABLE orders (
+            id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            text VARCHAR NOT NULL,
+            status VARCHAR NOT NULL DEFAULT 'pending',
+            driver_telegram_id INTEGER,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id),
+            UNIQUE (chat_id, message_id)
+        )
+        """,
+        # Recovery only ever looks for open orders, keep that index small
+        """
+        CREATE INDEX ix_orders_open ON orders (status)
+        WHERE status IN ('pending', 'offered')
+        """,
+        """
+        CREATE TABLE order_offers (
+            id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            driver_telegram_id INTEGER NOT NULL,
+            message_id INTEGER,
+            status VARCHAR NOT NULL DEFAULT 'offered',
+            offered_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            deadline DATETIME NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(order_id) REFERENCES orders (id)
+        )
+        """,
+        "CREATE INDEX ix_order_offers_order_id ON order_offers (order_id)",
+    ]),
+    (4, 'queue zones', [
+        # Existing queues become the default zone, positions are unique per zone
+        "ALTER TABLE queue ADD COLUMN zone VARCHAR NOT NULL DEFAULT 'default'",
+        "DROP INDEX ix_queue_position",
+        "CREATE UNIQUE INDEX ix_queue_zone_position ON queue (zone, position)",
+    ]),
+    (5, 'persistence data', [
+        # One row per key of user_data, chat_data and bot_data, keys and values pickled
+        """
+        CREATE TABLE persistence_data (
+            kind VARCHAR NOT NULL,
+            owner INTEGER NOT NULL,
+            key BLOB NOT NULL,
+            value BLOB NOT NULL,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, owner, key)
+        )
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _current_version(connection):
+    connection.exec_driver_sql(SCHEMA_VERSION_TABLE)
+    version = connection.exec_driver_sql(
+        "SELECT MAX(version) FROM schema_version"
+    ).scalar()
+    return version or 0
+
+
+async def migrate(engine):
+    """Bring the database behind engine up to LATEST_VERSION"""
+    async with engine.connect() as conn:
+        # pysqlite only opens a transaction before DML, so DDL would commit
+        # statement by statement. With the driver in autocommit, an explicit
+        # BEGIN makes each migration and its version row all or nothing.
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        current = await conn.run_sync(_current_version)
+
+        pending = [migration for migration in MIGRATIONS if migration[0] > current]
+        if not pending:
+            logger.info("Database schema is up to date (version %s)", current)
+            return current
+
+        for version, description, statements in pending:
+            await conn.exec_driver_sql("BEGIN")
+            try:
+                for statement in statements:
+                    await conn.exec_driver_sql(statement)
+                await conn.exec_driver_sql(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description)
+                )
+            except BaseException:
+                await conn.exec_driver_sql("ROLLBACK")
+                raise
+            await conn.exec_driver_sql("COMMIT")
+            logger.info("Applied migration %s: %s", version, description)
+    return LATEST_VERSION
@@ -0,0 +1,116 @@
+"""Open orders kept in memory while they look for a driver."""
+import time
+
+
+class OrderRecord:
+    """State of one open order.
+
+    status is 'offered' while a round of offers is out, 'pending' between
+    rounds and 'accepted' or 'expired' once the order left the registry.
+    offers maps the drivers of the current round to their offer message,
+    change it through OrderRegistry so the driver index stays in step.
+    """
+
+    __slots__ = ('id', 'zone', 'chat_id', 'text', 'message_id', 'status', 'round',
+                 'offers', 'skipped', 'offers_sent', 'sending', 'created')
+
+    def __init__(self, order_id, zone, chat_id, text, message_id, created=None):
+        self.id = order_id
+        self.zone = zone
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = message_id  # the order message in the group
+        self.status = 'pending'
+        self.round = 0
+        self.offers = {}  # driver id -> offer message id, for the current round
+        self.skipped = set()  # drivers who declined or missed this order
+        self.offers_sent = 0
+        self.sending = False  # a round of offers is still going out
+        self.created = time.monotonic() if created is None else created
+
+
+class OrderRegistry:
+    """Open orders by id, with offers indexed by driver.
+
+    Records are kept in the order they were added, oldest first, so
+    eviction by age (``expired``) and by the max_orders cap both take from
+    the front. Every lookup is a dict access.
+    """
+
+    def __init__(self, ttl=600, max_orders=10000):
+        self.ttl = ttl
+        self.max_orders = max_orders
+        self._orders = {}  # order id -> OrderRecord
+        self._by_driver = {}  # driver id -> order id of their open offer
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def get(self, order_id):
+        return self._orders.get(order_id)
+
+    def add(self, record):
+        """Register an order, returns the oldest orders evicted to stay under max_orders"""
+        evicted = []
+        while self._orders and len(self._orders) >= self.max_orders:
+            evicted.append(self.remove(next(iter(self._orders))))
+        self._orders[record.id] = record
+        for driver_id in record.offers:
+            self._by_driver[driver_id] = record.id
+        return evicted
+
+    def remove(self, order_id):
+        """Forget an order, returns its record (offers left as they were) or None"""
+        record = self._orders.pop(order_id, None)
+        if record is None:
+            return None
+        for driver_id in record.offers:
+            if self._by_driver.get(driver_id) == order_id:
+                del self._by_driver[driver_id]
+        return record
+
+    def add_offer(self, record, driver_id, message_id):
+        """Record an offer sent to driver_id, False if the order is no longer registered"""
+        if self._orders.get(record.id) is not record:
+            return False
+        record.offers[driver_id] = message_id
+        self._by_driver[driver_id] = record.id
+        return True
+
+    def remove_offer(self, record, driver_id):
+        """Drop a driver's offer, returns its message id or None"""
+        message_id = record.offers.pop(driver_id, None)
+        if self._by_driver.get(driver_id) == record.id:
+            del self._by_driver[driver_id]
+        return message_id
+
+    def clear_offers(self, record):
+        """End the current round, returns its offers"""
+        offers, record.offers = record.offers, {}
+        for driver_id in offers:
+            if self._by_driver.get(driver_id) == record.id:
+                del self._by_driver[driver_id]
+        return offers
+
+    def offer_for(self, driver_id):
+        """Id of the order driver_id has an open offer for, or None"""
+        return self._by_driver.get(driver_id)
+
+    def expired(self, now=None):
+        """Remove and return the orders older than ttl.
+
+        Stops at the first order that is young enough; orders are added
+        roughly in creation order, so any that come later expire at the
+        next call.
+        """
+        now = time.monotonic() if now is None else now
+        stale = []
+        while self._orders:
+            record = next(iter(self._orders.values()))
+            if now - record.created < self.ttl:
+                break
+            stale.append(self.remove(record.id))
+        return stale
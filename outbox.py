@@ -0,0 +1,281 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from logs import Event
+from tracing import CURRENT_TRACE
+
+logger = logging.getLogger(__name__)
+
+# Request priorities, lower goes first. Pass one as ``rate_limit_args`` to a
+# bot method to override the default picked from the endpoint. They start at
+# 1 because the bot drops falsy rate_limit_args.
+URGENT = 1  # order offers, accept confirmations, callback answers
+NORMAL = 2
+LOW = 3  # cosmetic edits such as menu updates
+
+# Edits of one message that are still waiting collapse into the newest one
+COALESCED_ENDPOINTS = ('editMessageText', 'editMessageReplyMarkup', 'editMessageCaption')
+DEFAULT_PRIORITIES = {
+    'answerCallbackQuery': URGENT,
+    'editMessageText': LOW,
+    'editMessageReplyMarkup': LOW,
+    'editMessageCaption': LOW,
+}
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0  # set from a RetryAfter
+
+    def wait_time(self, now, reserve=0.0):
+        """Seconds until a token is available while keeping reserve tokens back"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = 1 + reserve - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class _Request:
+    __slots__ = ('callback', 'args', 'kwargs', 'chat_id', 'priority', 'key', 'future', 'started', 'retries', 'sent_at')
+
+    def __init__(self, callback, args, kwargs, chat_id, priority, key, future):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.priority = priority
+        self.key = key
+        self.future = future
+        self.started = False
+        self.retries = 0
+        self.sent_at = None  # loop time it last went out
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """Rate limiter that queues every Bot API request the bot makes.
+
+    Requests wait in a priority heap and are sent by one scheduler task as
+    soon as both the global token bucket and the bucket of their chat have a
+    token, so a group that hit its limit does not hold up private chats.
+    Low priority requests leave a fifth of each bucket untouched, which keeps
+    room for order offers even while menu edits pile up. Edits of a message
+    that are still waiting are merged into the newest one and every caller
+    gets its result. A RetryAfter pauses the chat (or everything, for
+    requests without a chat) and puts the request back in the queue.
+    """
+
+    def __init__(self, global_rate=30.0, group_rate=20 / 60, private_rate=1.0,
+                 burst=3, max_retries=3):
+        self.global_rate = global_rate
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._heap = []  # (priority, seq, request)
+        self._pending_edits = {}  # (endpoint, chat_id, message_id) -> request
+        self._counter = itertools.count()
+        self._global = None
+        self._chats = {}  # chat_id -> TokenBucket
+        self._wakeup = None
+        self._task = None
+        self._sending = set()
+
+    @classmethod
+    def from_env(cls):
+        """SEND_RATE_GLOBAL and SEND_RATE_PRIVATE are per second, SEND_RATE_GROUP per minute"""
+        defaults = cls()
+        return cls(
+            global_rate=float(os.getenv('SEND_RATE_GLOBAL', defaults.global_rate)),
+            group_rate=float(os.getenv('SEND_RATE_GROUP', defaults.group_rate * 60)) / 60,
+            private_rate=float(os.getenv('SEND_RATE_PRIVATE', defaults.private_rate)),
+            burst=int(os.getenv('SEND_BURST', defaults.burst)),
+            max_retries=int(os.getenv('SEND_MAX_RETRIES', defaults.max_retries)),
+        )
+
+    def pending(self):
+        """Requests waiting to be sent.
+
+        Not ``__len__``: the bot checks the limiter for truth, an empty one
+        must not look like no limiter at all.
+        """
+        return sum(1 for _, _, request in self._heap if not request.started)
+
+    async def initialize(self):
+        # The application and its updater both initialize the bot, start only once
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._global = TokenBucket(self.global_rate, self.global_rate, loop.time())
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Let requests already on the wire finish before the bot closes its connections
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        for _, _, request in self._heap:
+            if not request.future.done():
+                request.future.cancel()
+        self._heap.clear()
+        self._pending_edits.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if self._task is None:
+            # Requests made before the application started, e.g. by a script
+            return await callback(*args, **kwargs)
+
+        request = self._enqueue(callback, args, kwargs, endpoint, data, rate_limit_args)
+        trace = CURRENT_TRACE.get()
+        if trace is None:
+            return await asyncio.shield(request.future)
+        started = time.perf_counter()
+        queued_at = asyncio.get_running_loop().time()
+        try:
+            return await asyncio.shield(request.future)
+        finally:
+            # Time waiting in the queue, the rest is the request itself
+            queued = request.sent_at - queued_at if request.sent_at else None
+            trace.add('bot', endpoint, started, time.perf_counter() - started, queued)
+
+    def _enqueue(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        """Queue a request, or merge it into a waiting edit of the same message"""
+        priority = rate_limit_args if rate_limit_args is not None else DEFAULT_PRIORITIES.get(endpoint, NORMAL)
+        chat_id = data.get('chat_id')
+        key = None
+        if endpoint in COALESCED_ENDPOINTS and data.get('message_id') is not None:
+            key = (endpoint, chat_id, data['message_id'])
+            request = self._pending_edits.get(key)
+            if request is not None and not request.started:
+                request.callback, request.args, request.kwargs = callback, args, kwargs
+                if priority < request.priority:
+                    request.priority = priority
+                    self._push(request)
+                logger.debug(Event('edit_coalesced', endpoint=endpoint, chat=chat_id, message=data['message_id']))
+                return request
+
+        request = _Request(callback, args, kwargs, chat_id, priority, key,
+                           asyncio.get_running_loop().create_future())
+        if key is not None:
+            self._pending_edits[key] = request
+        self._push(request)
+        return request
+
+    def _push(self, request):
+        heapq.heappush(self._heap, (request.priority, next(self._counter), request))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1024:
+                # Drop buckets of chats that have been quiet long enough to refill
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_idle(now)}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.private_rate, self.burst, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _next_ready(self, now):
+        """Pop the most urgent request that can be sent now, or return how long to wait"""
+        deferred = []
+        wait = None
+        ready = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            request = entry[2]
+            if request.started or request.future.done() or entry[0] != request.priority:
+                continue  # sent, cancelled or pushed again with a higher priority
+            reserve = 0.0 if request.priority < LOW else 0.2
+            delay = self._global.wait_time(now, reserve * self._global.capacity)
+            if delay > 0:
+                # The global bucket is shared, nothing behind this one can go either
+                deferred.append(entry)
+                wait = delay
+                break
+            if request.chat_id is not None:
+                bucket = self._chat_bucket(request.chat_id, now)
+                delay = bucket.wait_time(now, reserve * bucket.capacity)
+                if delay > 0:
+                    deferred.append(entry)
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                bucket.take()
+            self._global.take()
+            ready = request
+            break
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+        return ready, wait
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            request, wait = self._next_ready(now)
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            request.started = True
+            request.sent_at = now
+            if request.key is not None and self._pending_edits.get(request.key) is request:
+                del self._pending_edits[request.key]
+            task = loop.create_task(self._send(request))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, request):
+        try:
+            result = await request.callback(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            if request.retries >= self.max_retries:
+                logger.error("Giving up on request to chat %s after %s retries", request.chat_id, request.retries)
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            loop = asyncio.get_running_loop()
+            bucket = self._global if request.chat_id is None else self._chat_bucket(request.chat_id, loop.time())
+            bucket.blocked_until = max(bucket.blocked_until, loop.time() + e.retry_after)
+            logger.warning("Flood limit hit for chat %s, retrying in %ss", request.chat_id, e.retry_after)
+            request.retries += 1
+            request.started = False
+            self._push(request)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
@@ -0,0 +1,164 @@
+"""PTB persistence in the bot's own database.
+
+user_data, chat_data and bot_data are stored one row per key, so saving a
+user who changed one key writes one row instead of rewriting everything the
+way PicklePersistence does.
+"""
+import asyncio
+import logging
+import pickle
+
+from telegram.ext import BasePersistence
+
+from logs import Event
+
+logger = logging.getLogger(__name__)
+
+USER = 'user'
+CHAT = 'chat'
+BOT = 'bot'
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence on top of Database.
+
+    Nothing is read at startup for users and chats: an owner's rows are
+    loaded the first time one of their updates is handled, through
+    refresh_user_data / refresh_chat_data. Every update_interval seconds the
+    application hands over the data of everyone it touched; only keys whose
+    pickled value differs from what was last loaded or saved are queued, and
+    everything queued in one round is written in a single transaction.
+    """
+
+    def __init__(self, db, store_data=None, update_interval=60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.db = db
+        self._saved = {}  # (kind, owner) -> {pickled key: pickled value} as stored
+        self._drops = set()  # (kind, owner)
+        self._deletes = set()  # (kind, owner, pickled key)
+        self._upserts = {}  # (kind, owner, pickled key) -> pickled value
+        self._write_lock = asyncio.Lock()
+        self._write_task = None
+
+    async def _load(self, kind, owner, data):
+        if (kind, owner) in self._saved:
+            return
+        rows = await self.db.get_persisted_data(kind, owner)
+        saved = self._saved.setdefault((kind, owner), {})
+        for key, value in rows:
+            saved.setdefault(key, value)
+            # Keys set while the rows were being read are newer
+            data.setdefault(pickle.loads(key), pickle.loads(value))
+
+    def _stage(self, kind, owner, data):
+        """Queue the keys of data that changed since the last load or save"""
+        current = {
+            pickle.dumps(key, pickle.HIGHEST_PROTOCOL): pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            for key, value in data.items()
+        }
+        # None if never loaded: keys missing here may still be stored, leave them alone
+        saved = self._saved.get((kind, owner))
+        changed = False
+        for key, value in current.items():
+            if saved is None or saved.get(key) != value:
+                self._upserts[(kind, owner, key)] = value
+                self._deletes.discard((kind, owner, key))
+                changed = True
+        for key in saved.keys() - current.keys() if saved is not None else ():
+            self._deletes.add((kind, owner, key))
+            self._upserts.pop((kind, owner, key), None)
+            changed = True
+        self._saved[(kind, owner)] = current
+        if changed:
+            self._schedule_write()
+
+    def _drop(self, kind, owner):
+        self._drops.add((kind, owner))
+        self._deletes = {item for item in self._deletes if item[:2] != (kind, owner)}
+        self._upserts = {item: value for item, value in self._upserts.items() if item[:2] != (kind, owner)}
+        self._saved[(kind, owner)] = {}
+        self._schedule_write()
+
+    def _schedule_write(self):
+        # The application stages everyone in one round before this task gets to run
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self):
+        async with self._write_lock:
+            drops, deletes, upserts = self._drops, self._deletes, self._upserts
+            if not (drops or deletes or upserts):
+                return
+            self._drops, self._deletes, self._upserts = set(), set(), {}
+            try:
+                await self.db.write_persisted_data(
+                    drops, deletes, [item + (value,) for item, value in upserts.items()]
+                )
+                logger.debug(Event('persisted', keys=len(upserts), deleted=len(deletes), dropped=len(drops)))
+            except Exception as e:
+                logger.error("Error saving persistence data, retrying next round: %s", e)
+                self._requeue(drops, deletes, upserts)
+
+    def _requeue(self, drops, deletes, upserts):
+        """Put a failed batch back behind whatever was queued since"""
+        dropped_since = self._drops
+        self._drops = drops | dropped_since
+        for item in deletes:
+            if item[:2] not in dropped_since and item not in self._upserts:
+                self._deletes.add(item)
+        for item, value in upserts.items():
+            if item[:2] not in dropped_since and item not in self._deletes:
+                self._upserts.setdefault(item, value)
+
+    async def get_user_data(self):
+        return {}  # loaded per user by refresh_user_data
+
+    async def get_chat_data(self):
+        return {}  # loaded per chat by refresh_chat_data
+
+    async def get_bot_data(self):
+        data = {}
+        await self._load(BOT, 0, data)
+        return data
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._load(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._load(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass  # one process owns bot_data, it never changes behind our back
+
+    async def update_user_data(self, user_id, data):
+        self._stage(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage(CHAT, chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._stage(BOT, 0, data)
+
+    async def drop_user_data(self, user_id):
+        self._drop(USER, user_id)
+
+    async def drop_chat_data(self, chat_id):
+        self._drop(CHAT, chat_id)
+
+    async def get_callback_data(self):
+        return None  # arbitrary callback data is not used
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}  # conversations are not persisted
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def flush(self):
+        """Write whatever is still queued, called when the application stops"""
+        if self._write_task is not None:
+            await self._write_task
+        await self._write()
@@ -0,0 +1,209 @@
+from bisect import bisect_left, insort
+
+# Zone of the single GROUP_ID setup and of queue rows from before zones existed
+DEFAULT_ZONE = 'default'
+
+
+class QueueEngine:
+    """Process-local copy of the driver queue.
+
+    Drivers are keyed by telegram id and kept in queue position order, so the
+    head and tail are O(1) and a driver's rank is a binary search over the
+    sorted positions. Positions are sparse sequence keys that only grow, so
+    a driver leaving never renumbers the others. The ``queue`` table stays
+    the source of truth: the engine is loaded from it at startup and updated
+    after every commit.
+
+    Subscribers are told about every change as ``callback(event, *args)``:
+    ('load',), ('clear',), ('append', telegram_id, position) and
+    ('remove', telegram_id). Worker processes keep their copy of the
+    queue in step this way, see coordinator.py.
+    """
+
+    def __init__(self):
+        self._positions = []  # sorted positions of queued drivers
+        self._by_position = {}  # position -> telegram_id
+        self._by_driver = {}  # telegram_id -> position
+        self._last_position = 0  # highest position ever handed out
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _notify(self, event, *args):
+        for callback in self._subscribers:
+            callback(event, *args)
+
+    def load(self, rows):
+        """Replace the queue contents with (telegram_id, position) pairs"""
+        self._reset()
+        for telegram_id, position in rows:
+            self._by_driver[telegram_id] = position
+            self._by_position[position] = telegram_id
+        self._positions = sorted(self._by_position)
+        self._last_position = self._positions[-1] if self._positions else 0
+        self._notify('load')
+
+    def clear(self):
+        self._reset()
+        self._notify('clear')
+
+    def _reset(self):
+        self._positions.clear()
+        self._by_position.clear()
+        self._by_driver.clear()
+
+    def rows(self):
+        """(telegram_id, position) pairs in queue order"""
+        return [(self._by_position[position], position) for position in self._positions]
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self._by_driver
+
+    def __iter__(self):
+        """Telegram ids from the head of the queue to the tail.
+
+        Do not change the queue while iterating.
+        """
+        by_position = self._by_position
+        return (by_position[position] for position in self._positions)
+
+    def reserve_position(self):
+        """Hand out the position for a driver about to join.
+
+        Positions are reserved before the row is committed so concurrent
+        joins never get the same one; a rolled back join just leaves a gap.
+        """
+        self._last_position += 1
+        return self._last_position
+
+    def append(self, telegram_id, position):
+        """Put a driver into the queue at a reserved position"""
+        if telegram_id in self._by_driver:
+            raise ValueError(f"Driver already in queue: {telegram_id}")
+        if position in self._by_position:
+            raise ValueError(f"Position already taken: {position}")
+        self._by_driver[telegram_id] = position
+        self._by_position[position] = telegram_id
+        if not self._positions or position > self._positions[-1]:
+            self._positions.append(position)
+        else:
+            # a join that reserved earlier committed later
+            insort(self._positions, position)
+        self._last_position = max(self._last_position, position)
+        self._notify('append', telegram_id, position)
+
+    def remove(self, telegram_id):
+        """Drop a driver from the queue, returns False if they were not in it"""
+        position = self._by_driver.pop(telegram_id, None)
+        if position is None:
+            return False
+        del self._by_position[position]
+        del self._positions[bisect_left(self._positions, position)]
+        self._notify('remove', telegram_id)
+        return True
+
+    def position(self, telegram_id):
+        """Stored position of a driver or None"""
+        return self._by_driver.get(telegram_id)
+
+    def rank(self, telegram_id):
+        """1-based place of a driver in the queue or None"""
+        position = self._by_driver.get(telegram_id)
+        if position is None:
+            return None
+        return bisect_left(self._positions, position) + 1
+
+    def first(self):
+        """Telegram id of the driver at the head of the queue"""
+        return self._by_position[self._positions[0]] if self._positions else None
+
+    def last(self):
+        """Telegram id of the driver at the tail of the queue"""
+        return self._by_position[self._positions[-1]] if self._positions else None
+
+
+class ZoneQueues:
+    """One QueueEngine per zone, plus the zone each queued driver is in.
+
+    Zones are independent shards: positions, ranks and the head of the
+    queue are per zone, and changing one zone never touches another. A
+    driver is queued in at most one zone at a time. Engines are created on
+    first use.
+
+    Subscribers get every change of every zone as
+    ``callback(zone, event, *args)``, with the events of QueueEngine.
+    """
+
+    def __init__(self):
+        self._zones = {}  # zone -> QueueEngine
+        self._zone_of = {}  # telegram_id -> zone
+        self._subscribers = []
+
+    def zone(self, name):
+        """The queue of zone name"""
+        engine = self._zones.get(name)
+        if engine is None:
+            engine = self._zones[name] = QueueEngine()
+            engine.subscribe(lambda event, *args: self._changed(name, event, *args))
+        return engine
+
+    def zones(self):
+        return sorted(self._zones)
+
+    def zone_of(self, telegram_id):
+        """Zone whose queue a driver is in or None"""
+        return self._zone_of.get(telegram_id)
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _changed(self, zone, event, *args):
+        if event == 'append':
+            self._zone_of[args[0]] = zone
+        elif event == 'remove':
+            del self._zone_of[args[0]]
+        else:
+            # load or clear, rebuild this zone's part of the index
+            self._zone_of = {k: z for k, z in self._zone_of.items() if z != zone}
+            self._zone_of.update(dict.fromkeys(self._zones[zone], zone))
+        for callback in self._subscribers:
+            callback(zone, event, *args)
+
+    def load(self, rows):
+        """Replace every zone's contents with (zone, telegram_id, position) rows"""
+        by_zone = {name: [] for name in self._zones}
+        for zone, telegram_id, position in rows:
+            by_zone.setdefault(zone, []).append((telegram_id, position))
+        for zone, zone_rows in by_zone.items():
+            self.zone(zone).load(zone_rows)
+
+    def clear(self):
+        for engine in self._zones.values():
+            engine.clear()
+
+    def rows(self):
+        """(zone, telegram_id, position) for every queued driver"""
+        return [
+            (zone, telegram_id, position)
+            for zone, engine in sorted(self._zones.items())
+            for telegram_id, position in engine.rows()
+        ]
+
+    def __len__(self):
+        return len(self._zone_of)
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self._zone_of
+
+    def __iter__(self):
+        """Telegram ids of all queued drivers, in no particular order"""
+        return iter(self._zone_of)
+
+    def rank(self, telegram_id):
+        """1-based place of a driver in their zone's queue or None"""
+        zone = self._zone_of.get(telegram_id)
+        return self._zones[zone].rank(telegram_id) if zone is not None else None
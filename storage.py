@@ -0,0 +1,125 @@
+import os
+import logging
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+
+logger = logging.getLogger(__name__)
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+class StorageProfile:
+    """How the bot talks to its SQLite file.
+
+    The tuned defaults run the database in WAL mode so readers never block
+    the writer, keep connections (and their page cache) open instead of
+    reopening the file per session, and wait on a busy database instead of
+    failing straight away. SQLite allows one writer at a time, so writes go
+    through a single pooled connection and queue up in the event loop
+    rather than in SQLite's busy handler; listings use a read-only pool. ``StorageProfile.legacy()`` reproduces the old
+    hardcoded setup and is only kept for benchmarking.
+    """
+
+    def __init__(self, path='taxi_bot.db', echo=False, journal_mode='WAL',
+                 synchronous='NORMAL', busy_timeout_ms=5000, cache_size_kb=16384,
+                 mmap_size_mb=128, pool_size=1, read_pool_size=4):
+        self.path = path
+        self.echo = echo
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size_mb = mmap_size_mb
+        self.pool_size = pool_size
+        self.read_pool_size = read_pool_size
+
+    @classmethod
+    def from_env(cls):
+        """Build a profile from DATABASE_* and SQLITE_* environment variables"""
+        defaults = cls()
+        return cls(
+            path=os.getenv('DATABASE_PATH', defaults.path),
+            echo=_env_bool('DATABASE_ECHO', defaults.echo),
+            journal_mode=os.getenv('SQLITE_JOURNAL_MODE', defaults.journal_mode),
+            synchronous=os.getenv('SQLITE_SYNCHRONOUS', defaults.synchronous),
+            busy_timeout_ms=_env_int('SQLITE_BUSY_TIMEOUT_MS', defaults.busy_timeout_ms),
+            cache_size_kb=_env_int('SQLITE_CACHE_SIZE_KB', defaults.cache_size_kb),
+            mmap_size_mb=_env_int('SQLITE_MMAP_SIZE_MB', defaults.mmap_size_mb),
+            pool_size=_env_int('DATABASE_POOL_SIZE', defaults.pool_size),
+            read_pool_size=_env_int('DATABASE_READ_POOL_SIZE', defaults.read_pool_size),
+        )
+
+    @classmethod
+    def legacy(cls, path='taxi_bot.db'):
+        """Rollback journal, no pragmas, a new connection per session"""
+        return cls(path=path, journal_mode=None, synchronous=None, busy_timeout_ms=None,
+                   cache_size_kb=None, mmap_size_mb=None, pool_size=0, read_pool_size=0)
+
+    def url(self, read_only=False):
+        if read_only:
+            return f'sqlite+aiosqlite:///file:{self.path}?mode=ro&uri=true'
+        return f'sqlite+aiosqlite:///{self.path}'
+
+    def engine_options(self, read_only=False):
+        """Keyword arguments for create_async_engine"""
+        size = self.read_pool_size if read_only else self.pool_size
+        if not size:
+            return {'echo': self.echo, 'poolclass': NullPool}
+        return {
+            'echo': self.echo,
+            'poolclass': AsyncAdaptedQueuePool,
+            'pool_size': size,
+            'max_overflow': 0,
+        }
+
+    def pragmas(self, read_only=False):
+        """PRAGMA statements run on every new connection"""
+        statements = []
+        # journal_mode is stored in the file, read-only connections inherit it
+        if self.journal_mode and not read_only:
+            statements.append(f'PRAGMA journal_mode={self.journal_mode}')
+        if self.synchronous:
+            statements.append(f'PRAGMA synchronous={self.synchronous}')
+        if self.busy_timeout_ms is not None:
+            statements.append(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        if self.cache_size_kb:
+            # negative cache_size is in KiB rather than pages
+            statements.append(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        if self.mmap_size_mb is not None:
+            statements.append(f'PRAGMA mmap_size={int(self.mmap_size_mb) * 1024 * 1024}')
+        if read_only:
+            statements.append('PRAGMA query_only=ON')
+        return statements
+
+    def attach(self, engine, read_only=False):
+        """Apply the profile's pragmas whenever engine opens a connection"""
+        statements = self.pragmas(read_only)
+        if not statements:
+            return
+
+        @event.listens_for(engine.sync_engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            finally:
+                cursor.close()
+
+    def __repr__(self):
+        return (
+            f"StorageProfile(path={self.path!r}, journal_mode={self.journal_mode}, "
+            f"synchronous={self.synchronous}, pool_size={self.pool_size}, "
+            f"read_pool_size={self.read_pool_size})"
+        )
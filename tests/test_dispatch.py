@@ -0,0 +1,101 @@
+"""Concurrent orders must never book the same driver twice."""
+import asyncio
+import collections
+import importlib
+import os
+import random
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GROUP_ID = -1000000000001
+ORDERS = 50
+DRIVERS = 60
+
+
+class FakeBot:
+    """Answers the calls the order handlers make after a short random delay"""
+
+    def __init__(self):
+        self.message_ids = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None, reply_to_message_id=None,
+                           rate_limit_args=None):
+        await asyncio.sleep(random.random() * 0.005)
+        self.message_ids += 1
+        return SimpleNamespace(message_id=self.message_ids)
+
+    async def edit_message_text(self, **kwargs):
+        await asyncio.sleep(random.random() * 0.005)
+
+
+async def answer(*args, **kwargs):
+    pass
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # main reads its settings when imported
+    monkeypatch.setenv('TELEGRAM_TOKEN', '123456:TEST')
+    monkeypatch.setenv('GROUP_ID', str(GROUP_ID))
+    monkeypatch.setenv('BROADCAST_SIZE', '1')
+    monkeypatch.setenv('OFFER_TIMEOUT', '60')
+    monkeypatch.setenv('DATABASE_PATH', str(tmp_path / 'taxi_bot.db'))
+    sys.modules.pop('main', None)
+    random.seed(1)
+    yield importlib.import_module('main')
+    sys.modules.pop('main', None)
+
+
+async def dispatch_orders(main):
+    db = main.db
+    await db.init_db()
+    for telegram_id in range(1, DRIVERS + 1):
+        await db.add_driver({
+            'telegram_id': telegram_id,
+            'name': f'Driver {telegram_id}',
+            'car_model': 'Lada Vesta',
+            'car_number': f'A{telegram_id:03d}AA',
+            'status': 'inactive',
+        })
+    await asyncio.gather(*(db.add_to_queue(i) for i in range(1, DRIVERS + 1)))
+
+    context = SimpleNamespace(bot=FakeBot(), bot_data={}, args=None)
+    chat = SimpleNamespace(id=GROUP_ID)
+    updates = [
+        SimpleNamespace(
+            message=SimpleNamespace(chat=chat, text='нужно такси', message_id=1000 + i, reply_text=answer),
+            effective_user=SimpleNamespace(id=999),
+        )
+        for i in range(ORDERS)
+    ]
+    try:
+        await asyncio.gather(*(main.handle_order(update, context) for update in updates))
+        open_orders = [main.orders.get(order_id) for order_id in list(main.orders._orders)]
+        claims = collections.Counter(
+            driver_id
+            for dispatcher in main.dispatchers.values()
+            for driver_id in dispatcher._offers
+        )
+        return open_orders, claims, {
+            (order_id, driver_id)
+            for dispatcher in main.dispatchers.values()
+            for driver_id, order_id in dispatcher._offers.items()
+        }
+    finally:
+        await main.timers.stop()
+        await db.close()
+
+
+def test_concurrent_orders_claim_distinct_drivers(main):
+    open_orders, claims, reserved = asyncio.run(dispatch_orders(main))
+
+    assert len(open_orders) == ORDERS
+    offered = collections.Counter(d for order in open_orders for d in order.offers)
+    assert sum(offered.values()) == ORDERS
+    assert [d for d, n in offered.items() if n > 1] == []
+    assert [d for d, n in claims.items() if n > 1] == []
+    assert reserved == {(order.id, d) for order in open_orders for d in order.offers}
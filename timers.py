@@ -0,0 +1,113 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TimerService:
+    """Deadlines keyed by id, driven by a single background task.
+
+    Timers live in a heap ordered by deadline plus a dict from key to the
+    live heap entry. Cancelling just drops the dict entry, so it is O(1)
+    and the stale heap entry is skipped when it reaches the top. Only one
+    task sleeps, until the earliest live deadline; each expired timer runs
+    its callback in a short-lived task.
+    """
+
+    def __init__(self):
+        self._heap = []  # [deadline, seq, key, callback, args]
+        self._entries = {}  # key -> live heap entry
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._running = set()  # callbacks in flight, kept referenced until done
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, delay, callback, *args):
+        """Run ``await callback(*args)`` after delay seconds.
+
+        Scheduling a key that already has a timer replaces it. Returns the
+        deadline in event loop time.
+        """
+        loop = asyncio.get_running_loop()
+        self.cancel(key)
+        deadline = loop.time() + delay
+        entry = [deadline, next(self._counter), key, callback, args]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        elif self._heap[0] is entry:
+            self._wakeup.set()
+        return deadline
+
+    def cancel(self, key):
+        """Drop the timer for key, returns False if there was none"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[3] = None  # mark the heap entry as stale
+        # Rebuild once stale entries dominate so the heap stays bounded
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [item for item in self._heap if item[3] is not None]
+            heapq.heapify(self._heap)
+        return True
+
+    def pending(self):
+        """(key, seconds left) for every live timer, soonest first"""
+        now = asyncio.get_running_loop().time()
+        return sorted(
+            ((key, max(0.0, entry[0] - now)) for key, entry in self._entries.items()),
+            key=lambda item: item[1]
+        )
+
+    async def stop(self):
+        """Cancel the loop task and every pending timer"""
+        self._entries.clear()
+        self._heap.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while self._heap and self._heap[0][3] is None:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            deadline, _, key, callback, args = heapq.heappop(self._heap)
+            del self._entries[key]
+            task = loop.create_task(self._fire(key, callback, args))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, key, callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            logger.error("Error in timer %s: %s", key, e)
@@ -0,0 +1,162 @@
+"""Per-update tracing for finding out where a slow update spent its time.
+
+A Trace collects spans (database methods, Bot API calls, time in a worker
+process) for one update. The running update's trace is in CURRENT_TRACE, a
+context variable, so tasks started while handling it see it too. The hooks
+that record spans do nothing but read CURRENT_TRACE when no update is being
+traced, and nothing is traced unless TracingApplication is in use.
+"""
+import os
+import time
+import asyncio
+import itertools
+import logging
+from collections import deque
+from contextvars import ContextVar
+
+import callbacks
+from logs import Event
+
+logger = logging.getLogger(__name__)
+
+CURRENT_TRACE = ContextVar('current_trace', default=None)
+
+MAX_SPANS = 200  # per trace, further spans only count in the totals
+
+_ids = itertools.count(1)
+
+
+def _merged_duration(intervals):
+    """Time covered by (start, end) intervals, counting overlaps once"""
+    total = 0.0
+    end = None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+class Trace:
+    """Spans recorded while one update was handled"""
+
+    __slots__ = ('id', 'update', 'started', 'finished', 'spans', 'dropped')
+
+    def __init__(self, update):
+        self.id = f'{os.getpid():x}-{next(_ids):x}'
+        self.update = update
+        self.started = time.perf_counter()
+        self.finished = None
+        self.spans = []  # (kind, name, start, duration, queued)
+        self.dropped = 0
+
+    def add(self, kind, name, start, duration, queued=None):
+        if self.finished is not None:
+            return  # a task the update started outlived it, e.g. an offer timer
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((kind, name, start, duration, queued))
+        else:
+            self.dropped += 1
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        return self.finished - self.started
+
+    def totals(self):
+        """Seconds per span kind, overlapping spans of a kind counted once"""
+        intervals = {}
+        for kind, _, start, duration, _ in self.spans:
+            intervals.setdefault(kind, []).append((start, start + duration))
+        return {kind: _merged_duration(spans) for kind, spans in intervals.items()}
+
+    def breakdown(self):
+        """Spans in start order, e.g. ``+0.0 get_driver_state 2.1 | +2.3 sendMessage 40.2 (queued 38.0)``"""
+        parts = []
+        for kind, name, start, duration, queued in sorted(self.spans, key=lambda span: span[2]):
+            part = f'+{(start - self.started) * 1000:.1f} {name} {duration * 1000:.1f}'
+            if queued:
+                part += f' (queued {queued * 1000:.1f})'
+            parts.append(part)
+        if self.dropped:
+            parts.append(f'{self.dropped} more')
+        return ' | '.join(parts)
+
+
+def record(kind, name, start, duration, queued=None):
+    """Add a span to the trace of the update being handled, if any"""
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(kind, name, start, duration, queued)
+
+
+def describe(update):
+    """What an update was, without the user's text"""
+    if update.callback_query is not None:
+        return f'callback:{callbacks.describe(update.callback_query.data or "")}'
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith('/'):
+        return f'command:{message.text.split()[0]}'
+    return 'message' if message is not None else 'other'
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task sleeping interval seconds"""
+
+    def __init__(self, histogram, interval=0.1, keep=1200):
+        self.histogram = histogram
+        self.interval = interval
+        self.samples = deque(maxlen=keep)  # (woke up at, lag)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - started - self.interval)
+            self.samples.append((now, lag))
+            self.histogram.observe(lag)
+
+    def max_lag(self, since, until):
+        """Largest lag of the samples that overlap since..until"""
+        worst = 0.0
+        for woke, lag in reversed(self.samples):
+            if woke < since:
+                break
+            if woke - self.interval - lag <= until:
+                worst = max(worst, lag)
+        return worst
+
+
+def dump_slow(trace, elapsed, lag=None):
+    """Log a slow update with where its time went"""
+    totals = trace.totals()
+    accounted = sum(totals.values())
+    user = trace.update.effective_user
+    logger.warning(Event(
+        'slow_update',
+        trace=trace.id,
+        update=trace.update.update_id,
+        user=user.id if user else None,
+        what=describe(trace.update),
+        total_ms=round(elapsed * 1000, 1),
+        **{f'{kind}_ms': round(seconds * 1000, 1) for kind, seconds in sorted(totals.items())},
+        other_ms=round(max(0.0, elapsed - accounted) * 1000, 1),
+        loop_lag_ms=round(lag * 1000, 1) if lag is not None else None,
+        spans=trace.breakdown(),
+    ))
@@ -0,0 +1,210 @@
+"""How updates get into the application: webhook server, per-user ordering,
+tracing and the update types to ask Telegram for.
+"""
+import asyncio
+import hmac
+import json
+import logging
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
+    CommandHandler,
+    MessageHandler,
+    TypeHandler,
+)
+
+from callbacks import CallbackRouter
+from metrics import LOOP_LAG_SECONDS
+from tracing import CURRENT_TRACE, LoopLagMonitor, Trace, dump_slow
+
+logger = logging.getLogger(__name__)
+
+# Update types each handler class can match
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: (Update.MESSAGE,),
+    MessageHandler: (Update.MESSAGE,),
+    CallbackQueryHandler: (Update.CALLBACK_QUERY,),
+    CallbackRouter: (Update.CALLBACK_QUERY,),
+    # Only used to route updates between processes, it needs nothing of its own
+    TypeHandler: (),
+}
+
+MAX_UPDATE_SIZE = 1024 * 1024
+
+
+def allowed_updates_for(application):
+    """Update types the application has handlers for.
+
+    Falls back to every type if a handler class is not in
+    HANDLER_UPDATE_TYPES, so a new handler never silently gets nothing.
+    """
+    allowed = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            types = HANDLER_UPDATE_TYPES.get(type(handler))
+            if types is None:
+                logger.warning("Unknown update types for %s, asking for all updates", type(handler).__name__)
+                return Update.ALL_TYPES
+            allowed.update(types)
+    return sorted(allowed)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently, but one at a time per user.
+
+    Handlers keep per-user state (registration steps in user_data, menus,
+    queue membership), so two updates from the same user must not
+    interleave. Updates from different users, and updates without a user,
+    run in parallel up to max_concurrent_updates.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # user id -> [lock, updates holding or waiting for it]
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class TracingApplication(Application):
+    """Application that traces every update and logs the slow ones.
+
+    Only built when tracing is on (ApplicationBuilder.application_class),
+    otherwise updates go through the stock process_update untouched.
+    """
+
+    __slots__ = ('slow_threshold', 'lag_monitor')
+
+    def __init__(self, *, slow_threshold, **kwargs):
+        super().__init__(**kwargs)
+        self.slow_threshold = slow_threshold
+        self.lag_monitor = LoopLagMonitor(LOOP_LAG_SECONDS)
+
+    async def process_update(self, update):
+        if not isinstance(update, Update):
+            return await super().process_update(update)
+        trace = Trace(update)
+        token = CURRENT_TRACE.set(trace)
+        try:
+            await super().process_update(update)
+        finally:
+            CURRENT_TRACE.reset(token)
+            elapsed = trace.finish()
+            if elapsed >= self.slow_threshold:
+                dump_slow(trace, elapsed, self.lag_monitor.max_lag(trace.started, trace.finished))
+
+    async def start(self):
+        await super().start()
+        self.lag_monitor.start()
+
+    async def stop(self):
+        await self.lag_monitor.stop()
+        await super().stop()
+
+
+class WebhookServer:
+    """Minimal HTTP server taking Telegram webhook POSTs.
+
+    Checks the secret token Telegram echoes in the
+    X-Telegram-Bot-Api-Secret-Token header, puts the update on the
+    application's update queue and answers straight away; processing
+    happens in the application. Connections are kept alive so Telegram
+    can reuse them.
+    """
+
+    def __init__(self, application, secret_token, path='/'):
+        self.application = application
+        self.secret_token = secret_token
+        self.path = path
+        self._server = None
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        logger.info("Webhook server listening on %s:%s%s", host, port, self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_UPDATE_SIZE:
+                    await self._respond(writer, '413 Payload Too Large', close=True)
+                    break
+                body = await reader.readexactly(length)
+                status = await self._handle(request_line, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error("Error serving webhook request: %s", e)
+        finally:
+            writer.close()
+
+    async def _handle(self, request_line, headers, body):
+        parts = request_line.decode('latin-1').split()
+        if len(parts) < 2 or parts[1].split('?')[0] != self.path:
+            return '404 Not Found'
+        if parts[0] != 'POST':
+            return '405 Method Not Allowed'
+        secret = headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(secret.encode(), self.secret_token.encode()):
+            logger.warning("Webhook request with a wrong secret token")
+            return '403 Forbidden'
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning("Malformed webhook update: %s", e)
+            return '400 Bad Request'
+        await self.application.update_queue.put(update)
+        return '200 OK'
+
+    @staticmethod
+    async def _respond(writer, status, close=False):
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Length: 0\r\n'
+            f'Connection: {"close" if close else "keep-alive"}\r\n\r\n'.encode()
+        )
+        await writer.drain()